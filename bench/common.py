@@ -0,0 +1,54 @@
+"""Helpers shared by the benchmark scripts."""
+
+import os
+import sys
+import time
+import subprocess
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+LIB = os.path.join(BENCH, '..', 'lib')
+
+def xapers_env(root=None):
+    """Environment for running the xapers package of this source tree.
+
+    Commands are always run directly, not through a daemon.
+
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [LIB] + [p for p in env.get('PYTHONPATH', '').split(os.pathsep) if p])
+    env['XAPERS_NO_DAEMON'] = '1'
+    if root:
+        env['XAPERS_ROOT'] = root
+    return env
+
+def run(argv, env, stdin=None, check=False):
+    """Run a command, returning its wall clock time in seconds.
+
+    Output is discarded.  If 'check' is True a RuntimeError is raised
+    if the command fails.
+
+    """
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        status = subprocess.call(argv, stdin=stdin, stdout=devnull,
+                                 stderr=devnull, env=env)
+        elapsed = time.time() - start
+    if check and status != 0:
+        raise RuntimeError("command failed (%d): %s" % (status, ' '.join(argv)))
+    return elapsed
+
+def xapers(args, env, stdin=None, check=False):
+    """Run a xapers command, returning its wall clock time in seconds."""
+    return run([sys.executable, '-m', 'xapers'] + args, env,
+               stdin=stdin, check=check)
+
+def stats(times):
+    """Summarize a list of times, in seconds."""
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'min': times[0],
+        'median': times[len(times) / 2],
+        'max': times[-1],
+        }
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Compare two sets of benchmark results from run.py.
+
+usage: compare.py [--threshold=<fraction>] <base.json> <new.json>
+
+Prints the median time of each benchmark in both result sets and the
+relative change.  Benchmarks slower by more than the threshold
+(default 0.1, i.e. 10%) are marked as regressions, and if there are
+any the exit status is 1.
+
+"""
+
+import sys
+import json
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main():
+    threshold = 0.1
+    args = sys.argv[1:]
+    if args and args[0].startswith('--threshold='):
+        threshold = float(args.pop(0).split('=', 1)[1])
+    if len(args) != 2:
+        print >>sys.stderr, __doc__.strip()
+        sys.exit(1)
+    base, new = load(args[0]), load(args[1])
+
+    print 'base: %s' % (base.get('commit') or args[0])
+    print 'new:  %s' % (new.get('commit') or args[1])
+
+    regressions = 0
+    sizes = sorted(set(base['sizes']) & set(new['sizes']), key=int)
+    for size in sizes:
+        bresults = base['sizes'][size]
+        nresults = new['sizes'][size]
+        names = sorted(set(bresults) & set(nresults))
+        if not names:
+            continue
+        width = max([len(name) for name in names])
+        print
+        print '%s documents:' % size
+        print '  %-*s %10s %10s %8s' % (width, 'benchmark', 'base (s)', 'new (s)', 'change')
+        for name in names:
+            b = bresults[name]['median']
+            n = nresults[name]['median']
+            change = (n - b) / b if b else 0.0
+            mark = ''
+            if change > threshold:
+                mark = '  REGRESSION'
+                regressions += 1
+            print '  %-*s %10.3f %10.3f %+7.1f%%%s' % (width, name, b, n,
+                                                      change * 100, mark)
+
+    if regressions:
+        print
+        print '%d regression(s) beyond %.0f%%.' % (regressions, threshold * 100)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Generate a synthetic xapers library for benchmarking.
+
+usage: generate.py [--seed=N] [--words=N] [--extra=N] <count> <directory>
+
+Writes to <directory>:
+
+  library.bib   bibtex database of <count> entries, each with a doi,
+                authors, year, journal and a file field
+  files/        a generated PDF for each entry, holding --words words
+                (default 400) drawn from a Zipf distributed vocabulary
+  extra/        --extra (default 10) further entries not in the
+                library, as <n>.bib and <n>.pdf, for timing 'add'
+  tags.batch    tag operations for 'tag --batch', giving the documents
+                a Zipf distributed set of tags
+  library.json  the generation parameters, and words and tags of known
+                frequency for use in queries
+
+Output is deterministic for a given seed, so libraries generated for
+different commits are identical.  Extracting text from the PDFs
+requires pdftotext, as for any xapers library.
+
+"""
+
+import os
+import sys
+import json
+import bisect
+import random
+
+VOCABULARY = 5000
+TAGS = 50
+LINES_PER_PAGE = 50
+WORDS_PER_LINE = 10
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'su', 'ta', 'ri', 'po', 've', 'da',
+             'gu', 'ho', 'ba', 'ze', 'fi', 'qua', 'ster', 'on', 'ex', 'al']
+
+JOURNALS = ['Journal of Synthetic Results', 'Annals of Benchmarking',
+            'Letters in Reproducibility', 'Review of Generated Physics',
+            'Proceedings of the Imaginary Society']
+
+class Zipf(object):
+    """Draw items with probability inversely proportional to rank."""
+
+    def __init__(self, items, rng):
+        self.items = items
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, len(items) + 1):
+            total += 1.0 / rank
+            self.cumulative.append(total)
+
+    def __call__(self):
+        x = self.rng.random() * self.cumulative[-1]
+        return self.items[bisect.bisect_left(self.cumulative, x)]
+
+def make_words(rng, count):
+    words = set()
+    while len(words) < count:
+        words.add(''.join([rng.choice(SYLLABLES)
+                           for i in range(rng.randint(2, 4))]))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+def make_pdf(lines):
+    """Return a minimal PDF document showing lines of ascii text."""
+    pages = [lines[i:i + LINES_PER_PAGE]
+             for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+    npages = len(pages)
+    # objects 1 and 2 are the catalog and page tree, 3 the font, then
+    # a page and a content stream object per page
+    objects = [
+        '<< /Type /Catalog /Pages 2 0 R >>',
+        '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(['%d 0 R' % (4 + 2 * i) for i in range(npages)]), npages),
+        '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        ]
+    for i, page in enumerate(pages):
+        text = ['BT', '/F1 10 Tf', '14 TL', '50 750 Td']
+        for line in page:
+            line = line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+            text.append('(%s) Tj T*' % line)
+        text.append('ET')
+        stream = '\n'.join(text)
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       '/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>' % (5 + 2 * i))
+        objects.append('<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+
+    pdf = '%PDF-1.4\n'
+    offsets = []
+    for num, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += '%d 0 obj\n%s\nendobj\n' % (num, obj)
+    xref = len(pdf)
+    pdf += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        pdf += '%010d 00000 n \n' % offset
+    pdf += 'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1, xref)
+    return pdf
+
+class Generator(object):
+
+    def __init__(self, seed=0, words=400):
+        self.rng = random.Random(seed)
+        self.words = make_words(self.rng, VOCABULARY)
+        self.word = Zipf(self.words, self.rng)
+        self.names = [w.capitalize() for w in make_words(self.rng, 500)]
+        self.name = Zipf(self.names, self.rng)
+        self.tags = ['t%02d' % i for i in range(TAGS)]
+        self.tag = Zipf(self.tags, self.rng)
+        self.nwords = words
+
+    def text(self, count):
+        return ' '.join([self.word() for i in range(count)])
+
+    def entry(self, key, doi, path):
+        rng = self.rng
+        authors = ' and '.join(['%s, %s' % (self.name(), self.name())
+                                for i in range(rng.randint(1, 5))])
+        fields = [
+            ('title', self.text(rng.randint(3, 10)).capitalize()),
+            ('author', authors),
+            ('year', str(rng.randint(1950, 2020))),
+            ('journal', rng.choice(JOURNALS)),
+            ('doi', doi),
+            ('file', ':%s:pdf' % path),
+            ]
+        return '@article{%s,\n%s\n}\n' % (
+            key, ',\n'.join(['    %s = {%s}' % field for field in fields]))
+
+    def document(self):
+        lines = [self.text(WORDS_PER_LINE)
+                 for i in range(max(1, self.nwords / WORDS_PER_LINE))]
+        return make_pdf(lines)
+
+    def tag_ops(self, count):
+        # each document gets one to three tags, most often the
+        # lowest numbered ones
+        ops = {}
+        for docid in range(1, count + 1):
+            for i in range(self.rng.randint(1, 3)):
+                ops.setdefault(self.tag(), []).append(docid)
+        lines = []
+        for tag in sorted(ops):
+            docids = sorted(set(ops[tag]))
+            # keep queries short, so no line is a pathological query
+            for i in range(0, len(docids), 100):
+                lines.append('+%s -- %s\n' % (
+                    tag, ' OR '.join(['id:%d' % d for d in docids[i:i + 100]])))
+        return lines
+
+def generate(directory, count, seed=0, words=400, extra=10):
+    directory = os.path.abspath(directory)
+    for sub in ['files', 'extra']:
+        path = os.path.join(directory, sub)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    gen = Generator(seed, words)
+
+    with open(os.path.join(directory, 'library.bib'), 'w') as bib:
+        for i in range(1, count + 1):
+            path = os.path.join(directory, 'files', '%d.pdf' % i)
+            bib.write(gen.entry('bench%d' % i, '10.5555/bench.%d' % i, path))
+            bib.write('\n')
+            with open(path, 'wb') as f:
+                f.write(gen.document())
+
+    for i in range(1, extra + 1):
+        base = os.path.join(directory, 'extra', '%d' % i)
+        with open(base + '.bib', 'w') as f:
+            f.write(gen.entry('extra%d' % i, '10.5555/extra.%d' % i, base + '.pdf'))
+        with open(base + '.pdf', 'wb') as f:
+            f.write(gen.document())
+
+    with open(os.path.join(directory, 'tags.batch'), 'w') as f:
+        f.writelines(gen.tag_ops(count))
+
+    info = {
+        'count': count,
+        'seed': seed,
+        'words': words,
+        'extra': extra,
+        # by rank: common, middling and rare
+        'terms': [gen.words[0], gen.words[50], gen.words[2000]],
+        'tags': [gen.tags[0], gen.tags[10], gen.tags[TAGS - 1]],
+        }
+    with open(os.path.join(directory, 'library.json'), 'w') as f:
+        json.dump(info, f, indent=2)
+    return info
+
+def main():
+    seed = 0
+    words = 400
+    extra = 10
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        opt, value = args.pop(0).split('=', 1)
+        if opt == '--seed':
+            seed = int(value)
+        elif opt == '--words':
+            words = int(value)
+        elif opt == '--extra':
+            extra = int(value)
+        else:
+            print >>sys.stderr, "Unknown option '%s'." % opt
+            sys.exit(1)
+    if len(args) != 2:
+        print >>sys.stderr, __doc__.strip()
+        sys.exit(1)
+    generate(args[1], int(args[0]), seed=seed, words=words, extra=extra)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Render nci search results headless, for benchmarking.
+
+usage: render.py [--pages=N] [--size=<cols>x<rows>] <search-terms>
+
+Builds the nci search buffer for the query against the document store
+in XAPERS_ROOT, retrieves all results, and renders it to a canvas,
+paging down N times (default 10), without a terminal.
+
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+class HeadlessUI(object):
+    """The parts of nci.ui.UI used by buffers, without a screen."""
+
+    def __init__(self, db):
+        self.db = db
+        self.devnull = open(os.devnull, 'r+')
+
+    def set_header(self, widget=[]):
+        pass
+
+    def set_status(self, text=None):
+        pass
+
+    def keypress(self, key):
+        pass
+
+def main():
+    pages = 10
+    cols, rows = 120, 50
+    args = sys.argv[1:]
+    while args and args[0].startswith('--'):
+        opt, value = args.pop(0).split('=', 1)
+        if opt == '--pages':
+            pages = int(value)
+        elif opt == '--size':
+            cols, rows = [int(v) for v in value.split('x')]
+        else:
+            print >>sys.stderr, "Unknown option '%s'." % opt
+            sys.exit(1)
+    query = ' '.join(args) or '*'
+
+    from xapers.cli import initdb
+    from xapers.nci.search import Search
+
+    size = (cols, rows)
+    buf = Search(HeadlessUI(initdb()), query)
+    # no main loop to run the search in the background
+    buf.load()
+    buf.render(size, focus=True)
+    for i in range(pages):
+        # paging is handled by the list box, not the buffer's keymap
+        buf.listbox.keypress(size, 'page down')
+        buf.render(size, focus=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""Run the xapers benchmark suite.
+
+usage: run.py [options] <workdir>
+
+  -n <runs>              runs of each repeatable benchmark (default 5)
+  --sizes=N[,...]        library sizes (default 1000,10000,100000)
+  --output=<file>        write results as json to file (default stdout)
+  --only=<name>[,...]    run only benchmarks whose names start with
+                         one of the given prefixes
+
+For each size a synthetic library is generated in <workdir> (see
+generate.py; libraries are reused if already present), imported in to
+a fresh document store, and the following are timed:
+
+  import, add, restore (full and incremental), count, search in every
+  output format, tag (single and --batch), export and headless nci
+  rendering (see render.py)
+
+Commands mutating the store, or too slow to repeat, run once; the
+rest are run <runs> times.  The results record the commit, and can be
+compared across commits with compare.py.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+
+import generate
+from common import BENCH, xapers_env, xapers, run, stats
+
+SIZES = [1000, 10000, 100000]
+
+def commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                           cwd=BENCH, stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def library(workdir, size):
+    path = os.path.join(workdir, 'library-%d' % size)
+    info = os.path.join(path, 'library.json')
+    if os.path.exists(info):
+        with open(info) as f:
+            return path, json.load(f)
+    print >>sys.stderr, "generating library of %d documents..." % size
+    return path, generate.generate(path, size)
+
+class Suite(object):
+
+    def __init__(self, runs, only=None):
+        self.runs = runs
+        self.only = only
+        self.results = {}
+
+    def wanted(self, name):
+        return not self.only or [p for p in self.only if name.startswith(p)]
+
+    def time(self, name, func, repeat=True, required=False):
+        if not required and not self.wanted(name):
+            return
+        print >>sys.stderr, "  %s..." % name,
+        times = [func() for i in range(repeat and self.runs or 1)]
+        self.results[name] = stats(times)
+        print >>sys.stderr, "%.3f s" % self.results[name]['median']
+
+def bench_size(workdir, size, runs, only=None):
+    libdir, info = library(workdir, size)
+    root = os.path.join(workdir, 'root-%d' % size)
+    if os.path.exists(root):
+        shutil.rmtree(root)
+    os.makedirs(root)
+    env = xapers_env(root)
+    bib = os.path.join(libdir, 'library.bib')
+    suite = Suite(runs, only)
+    common, middling, rare = info['terms']
+    tag0, tag1, tag2 = info['tags']
+
+    print >>sys.stderr, "%d documents:" % size
+
+    # the store is built by the first import, so it always runs
+    suite.time('import', lambda: xapers(['import', '--tags=new', bib], env,
+                                        check=True), repeat=False, required=True)
+
+    suite.time('import.reimport',
+               lambda: xapers(['import', bib], env, check=True), repeat=False)
+
+    extra = iter(range(1, info['extra'] + 1))
+    def add():
+        base = os.path.join(libdir, 'extra', '%d' % extra.next())
+        return xapers(['add', '--source=' + base + '.bib', '--file=' + base + '.pdf'],
+                      env, check=True)
+    if info['extra']:
+        # each run adds a new document
+        suite.time('add', add, repeat=info['extra'] >= runs)
+
+    suite.time('count.all', lambda: xapers(['count'], env))
+    suite.time('count.term', lambda: xapers(['count', common], env))
+    suite.time('count.tag', lambda: xapers(['count', 'tag:new'], env))
+    suite.time('count.year', lambda: xapers(['count', 'year:1980..1990'], env))
+
+    for oformat in ['summary', 'bibtex', 'tags', 'sources', 'keys', 'files', 'facets']:
+        suite.time('search.%s' % oformat,
+                   lambda o=oformat: xapers(['search', '--output=' + o, middling], env))
+    suite.time('search.all.limit', lambda: xapers(['search', '--limit=20', '*'], env))
+    suite.time('search.common.sort', lambda: xapers(['search', '--sort=title', common], env))
+    suite.time('search.rare', lambda: xapers(['search', rare], env))
+    suite.time('search.bool', lambda: xapers(['search', common, 'AND', 'NOT', middling,
+                                             'AND', 'year:1960..2000'], env))
+
+    suite.time('tag.add', lambda: xapers(['tag', '+bench', '--', middling], env),
+               repeat=False)
+    # tags already present, so no document changes
+    suite.time('tag.noop', lambda: xapers(['tag', '+bench', '--', middling], env))
+    suite.time('tag.remove', lambda: xapers(['tag', '-bench', '--', middling], env),
+               repeat=False)
+    def tag_batch():
+        with open(os.path.join(libdir, 'tags.batch')) as f:
+            return xapers(['tag', '--batch'], env, stdin=f, check=True)
+    suite.time('tag.batch', tag_batch, repeat=False)
+
+    suite.time('count.batch-tag', lambda: xapers(['count', 'tag:' + tag0], env))
+    suite.time('search.batch-tag', lambda: xapers(['search', 'tag:' + tag1], env))
+
+    def export():
+        dest = os.path.join(workdir, 'export-%d' % size)
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        return xapers(['export', dest, 'tag:' + tag2], env)
+    suite.time('export', export)
+
+    suite.time('nci.render', lambda: run([sys.executable,
+                                          os.path.join(BENCH, 'render.py'), common], env))
+
+    suite.time('restore.incremental',
+               lambda: xapers(['restore', '--incremental'], env, check=True))
+    suite.time('restore', lambda: xapers(['restore'], env, check=True), repeat=False)
+
+    return suite.results
+
+def main():
+    runs = 5
+    sizes = SIZES
+    output = None
+    only = None
+    args = sys.argv[1:]
+    while args and args[0].startswith('-'):
+        arg = args.pop(0)
+        if arg == '-n':
+            runs = int(args.pop(0))
+        elif arg.startswith('--sizes='):
+            sizes = [int(s) for s in arg.split('=', 1)[1].split(',')]
+        elif arg.startswith('--output='):
+            output = arg.split('=', 1)[1]
+        elif arg.startswith('--only='):
+            only = arg.split('=', 1)[1].split(',')
+        else:
+            print >>sys.stderr, "Unknown option '%s'." % arg
+            sys.exit(1)
+    if len(args) != 1:
+        print >>sys.stderr, __doc__.strip()
+        sys.exit(1)
+    workdir = os.path.abspath(args[0])
+
+    results = {
+        'commit': commit(),
+        'time': time.time(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'runs': runs,
+        'sizes': {},
+        }
+    for size in sizes:
+        results['sizes'][str(size)] = bench_size(workdir, size, runs, only)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+if __name__ == '__main__':
+    main()
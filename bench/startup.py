@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Measure xapers command startup time.
+
+Runs each xapers subcommand repeatedly against the document store in
+XAPERS_ROOT and reports the fastest and median wall clock times.  The
+xapers package is taken from the lib directory of this source tree.
+
+usage: startup.py [-n <runs>] [<command> ...]
+
+Commands are given as single, space separated strings,
+e.g. 'count tag:new'.  The default is a set of read-only commands.
+
+"""
+
+import os
+import sys
+
+from common import xapers_env, xapers, stats
+
+COMMANDS = [
+    'version',
+    'help',
+    'maxid',
+    'count',
+    'count tag:new',
+    'search --limit=10 *',
+    'bibtex id:1',
+    'dumpterms --prefix=K *',
+    'sources',
+    ]
+
+def main():
+    runs = 10
+    args = sys.argv[1:]
+    if args[:1] == ['-n']:
+        runs = int(args[1])
+        args = args[2:]
+    commands = args or COMMANDS
+
+    if 'XAPERS_ROOT' not in os.environ:
+        print >>sys.stderr, "XAPERS_ROOT must point to a document store."
+        sys.exit(1)
+
+    env = xapers_env()
+
+    width = max([len(command) for command in commands])
+    print '%-*s %9s %9s' % (width, 'command', 'min (ms)', 'med (ms)')
+    for command in commands:
+        s = stats([xapers(command.split(), env) for i in range(runs)])
+        print '%-*s %9.1f %9.1f' % (width, command,
+                                    s['min'] * 1000, s['median'] * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -23,10 +23,10 @@ import sys
 import codecs
 import signal
 
-import cli
-from source import Sources, SourceError
-from bibtex import Bibtex, BibtexError
-from parser import ParseError
+# only modules needed by every command are imported here.  commands
+# import what they use, to keep startup fast.
+import daemon
+import instrument
 
 ########################################################################
 
@@ -43,29 +43,56 @@ Commands:
     --source=[<sid>|<file>]             source id, for online retrieval, or
                                         bibtex file path
     --file[=<file>]                     PDF file to index and archive
+    --link                              hard link the file in to the archive
+                                        rather than copying it
     --tags=<tag>[,...]                  initial tags
     --prompt                            prompt for unspecified options
     --view                              view entry after adding
+    --from-list=<file>                  add documents for all sources listed
+                                        in file, one per line, retrieving
+                                        them concurrently (with --file,
+                                        retrieve files too)
+    --jobs=N                            number of concurrent retrievals for
+                                        --from-list (default 8)
   import <bibtex-file>                Import entries from a bibtex database.
     --tags=<tag>[,...]                  tags to apply to all imported documents
+    --link                              hard link files in to the archive
+                                        rather than copying them
+    --batch=N                           commit to the database every N entries
+    --jobs=N                            number of parallel text extractions
   delete <search-terms>               Delete documents from database.
     --noprompt                          do not prompt to confirm deletion
   restore                             Restore database from an existing xapers
                                       root directory.
+    --jobs=N                            number of parallel text extractions
+    --incremental                       only reindex new or changed documents,
+                                        and remove deleted ones
 
   tag +<tag>|-<tag> [...] [--] <search-terms>
                                       Add/remove tags.
+  tag --batch[=<file>]                Apply tag operations read from file
+                                      (or stdin), one per line as above, in
+                                      a single transaction.
 
   search [options] <search-terms>     Search for documents.
-    --output=[summary|bibtex|tags|sources|keys|files]
+    --output=[summary|bibtex|tags|sources|keys|files|facets]
                                         output format (default is 'summary')
+    --facets=<facet>[,...]              facets counted for 'facets' output
+                                        (tag, source, year; default all)
     --limit=N                           limit number of results returned
+    --offset=N                          skip the first N results
+    --sort=[relevance|year|added|modified|title|author]
+                                        result order (default is relevance,
+                                        newest first)
   bibtex <search-terms>               Short for \"search --output=bibtex\".
-  view <search-terms>                 View search in curses UI.
+  view [--sort=<order>] <search-terms>
+                                      View search in curses UI.
   count <search-terms>                Count matches.
 
   export <dir> <search-terms>         Export documents to a directory of files
                                       named for document titles.
+  daemon                              Serve search, bibtex, count and tag
+                                      commands from a long-running process.
 
   sources                             List available sources.
   source2url <sid> [...]              Output URLs for sources.
@@ -108,8 +135,15 @@ Additionally, the following prefixed terms are understood (where
   year:<since>..<until>        publication year range (also y:)
   year:..<until>
   year:<since>..
+  added:<since>..<until>       date range document was added
+  modified:<since>..<until>    date range document was last modified
 
-Publication years must be four-digit integers.
+Publication years must be four-digit integers.  Added and modified
+dates are local dates, YYYY-MM-DD, optionally followed by a THH:MM or
+THH:MM:SS time, or times relative to now, given as a number of hours,
+days, weeks or years ago, e.g. 12h, 7d, 2w or 1y.  Either end of a
+date range can be left open, e.g. "added:7d.." for documents added in
+the last week.
 
 See the following for more information on search terms:
 
@@ -120,14 +154,12 @@ See the following for more information on search terms:
 # combine a list of terms with spaces between, so that simple queries
 # don't have to be quoted at the shell level.
 def make_query_string(terms, require=True):
-    string = str.join(' ', terms)
-    if string == '':
-        if require:
-            print >>sys.stderr, "Must specify a search term."
-            sys.exit(1)
-        else:
-            string = '*'
-    return string
+    import cli
+    try:
+        return cli.make_query_string(terms, require=require)
+    except ValueError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
 
 def import_nci():
     try:
@@ -155,14 +187,31 @@ if __name__ == '__main__':
     else:
         cmd = []
 
+    # hand commands off to a running daemon, if there is one
+    if daemon.serves(sys.argv[1:]) and not os.getenv('XAPERS_NO_DAEMON'):
+        try:
+            status = daemon.call(sys.argv[1:])
+        except (daemon.DaemonError, IOError) as e:
+            print >>sys.stderr, e
+            sys.exit(1)
+        if status is not None:
+            sys.exit(status)
+
+    # report where the time went, with XAPERS_PROFILE
+    instrument.start(' '.join(sys.argv[1:]))
+
     ########################################
     if cmd in ['add','a']:
+        import cli
         tags = None
         infile = None
         sid = None
         prompt = False
         view = False
         query = None
+        listfile = None
+        jobs = 8
+        link = False
 
         argc = 2
         while True:
@@ -170,6 +219,12 @@ if __name__ == '__main__':
                 break
             elif '--source=' in sys.argv[argc]:
                 sid = sys.argv[argc].split('=',1)[1]
+            elif '--from-list=' in sys.argv[argc]:
+                listfile = sys.argv[argc].split('=',1)[1]
+            elif '--jobs=' in sys.argv[argc]:
+                jobs = int(sys.argv[argc].split('=',1)[1])
+            elif '--link' in sys.argv[argc]:
+                link = True
             elif '--file' in sys.argv[argc]:
                 if '=' in sys.argv[argc]:
                     infile = sys.argv[argc].split('=',1)[1]
@@ -185,11 +240,24 @@ if __name__ == '__main__':
                 break
             argc += 1
 
+        if listfile:
+            if sid or prompt or view or link or argc < len(sys.argv) \
+               or (infile and infile is not True):
+                print >>sys.stderr, "--from-list can only be combined with --file, --tags and --jobs."
+                sys.exit(1)
+            if not os.path.exists(listfile):
+                print >>sys.stderr, "File not found: %s" % listfile
+                sys.exit(1)
+            with cli.initdb(writable=True, create=True) as db:
+                cli.add_from_list(db, listfile, tags=tags, files=bool(infile), jobs=jobs)
+            sys.exit(0)
+
         if argc == (len(sys.argv) - 1):
             query = make_query_string(sys.argv[argc:])
 
         with cli.initdb(writable=True, create=True) as db:
-            docid = cli.add(db, query, infile=infile, sid=sid, tags=tags, prompt=prompt)
+            docid = cli.add(db, query, infile=infile, sid=sid, tags=tags, prompt=prompt,
+                            link=link)
 
         if view and docid:
             nci = import_nci()
@@ -197,7 +265,12 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['import','i']:
+        import multiprocessing
+        import cli
         tags = []
+        batch = 1000
+        jobs = multiprocessing.cpu_count()
+        link = False
 
         argc = 2
         while True:
@@ -207,6 +280,12 @@ if __name__ == '__main__':
                 tags = sys.argv[argc].split('=',1)[1].split(',')
             elif '--overwrite' in sys.argv[argc]:
                 overwrite = True
+            elif '--link' in sys.argv[argc]:
+                link = True
+            elif '--batch=' in sys.argv[argc]:
+                batch = int(sys.argv[argc].split('=',1)[1])
+            elif '--jobs=' in sys.argv[argc]:
+                jobs = int(sys.argv[argc].split('=',1)[1])
             else:
                 break
             argc += 1
@@ -222,10 +301,11 @@ if __name__ == '__main__':
             sys.exit(1)
 
         with cli.initdb(writable=True, create=True) as db:
-            cli.importbib(db, bibfile, tags=tags)
+            cli.importbib(db, bibfile, tags=tags, batch=batch, jobs=jobs, link=link)
 
     ########################################
     elif cmd in ['update']:
+        import cli
         argc = 2
         query = make_query_string(sys.argv[argc:])
         with cli.initdb(writable=True) as db:
@@ -241,6 +321,7 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['delete']:
+        import cli
         prompt = True
 
         argc = 2
@@ -255,11 +336,11 @@ if __name__ == '__main__':
 
         query = make_query_string(sys.argv[argc:])
         with cli.initdb(writable=True) as db:
-            count = db.count(query)
-            if count == 0:
+            docs = db.search(query)
+            if len(docs) == 0:
                 print >>sys.stderr, "No documents found for query."
                 sys.exit(1)
-            for doc in db.search(query):
+            for doc in docs:
                 if prompt:
                     resp = raw_input("Type 'yes' to delete document id:%d: " % doc.docid)
                     if resp != 'yes':
@@ -270,32 +351,19 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['search','s']:
-        oformat = 'summary'
-        limit = 0
-
-        argc = 2
-        while True:
-            if argc >= len(sys.argv):
-                break
-            if '--output=' in sys.argv[argc]:
-                oformat = sys.argv[argc].split('=')[1]
-            elif '--limit=' in sys.argv[argc]:
-                limit = int(sys.argv[argc].split('=')[1])
-            else:
-                break
-            argc += 1
-
-        if oformat not in ['summary','bibtex','tags','sources','keys','files']:
-            print >>sys.stderr, "Unknown output format."
+        import cli
+        try:
+            query, options = cli.parse_search_args(sys.argv[2:])
+        except ValueError as e:
+            print >>sys.stderr, e
             sys.exit(1)
-
-        query = make_query_string(sys.argv[argc:])
         set_stdout_codec()
         with cli.initdb() as db:
-            cli.search(db, query, oformat=oformat, limit=limit)
+            cli.search(db, query, **options)
 
     ########################################
     elif cmd in ['bibtex','bib','b']:
+        import cli
         argc = 2
         query = make_query_string(sys.argv[argc:])
         set_stdout_codec()
@@ -308,47 +376,47 @@ if __name__ == '__main__':
         if cmd == 'nci':
             args = sys.argv[2:]
         else:
-            query = make_query_string(sys.argv[2:], require=False)
-            args = ['search', query]
+            argc = 2
+            args = ['search']
+            if len(sys.argv) > argc and '--sort=' in sys.argv[argc]:
+                args.append(sys.argv[argc])
+                argc += 1
+            query = make_query_string(sys.argv[argc:], require=False)
+            args.append(query)
         nci.UI(cmd=args)
 
     ########################################
     elif cmd in ['tag','t']:
-        add_tags = []
-        remove_tags = []
+        import cli
 
-        argc = 2
-        for arg in sys.argv[argc:]:
-            if argc >= len(sys.argv):
-                break
-            if arg == '--':
-                argc += 1
-                continue
-            if arg[0] == '+':
-                add_tags.append(arg[1:])
-            elif arg[0] == '-':
-                remove_tags.append(arg[1:])
+        if sys.argv[2:3] and sys.argv[2].startswith('--batch'):
+            if '=' in sys.argv[2]:
+                batchfile = sys.argv[2].split('=',1)[1]
+                if not os.path.exists(batchfile):
+                    print >>sys.stderr, "File not found: %s" % batchfile
+                    sys.exit(1)
             else:
-                break
-            argc += 1
-
-        if not add_tags and not remove_tags:
-            print >>sys.stderr, "Must specify tags to add or remove."
-            sys.exit(1)
+                batchfile = None
+            with cli.initdb(writable=True) as db:
+                if batchfile:
+                    with open(batchfile, 'r') as f:
+                        cli.tag_batch(db, f)
+                else:
+                    cli.tag_batch(db, sys.stdin)
+            sys.exit(0)
 
-        if '' in add_tags:
-            print >>sys.stderr, "Null tags not allowed."
+        try:
+            add_tags, remove_tags, query = cli.parse_tag_args(sys.argv[2:])
+        except ValueError as e:
+            print >>sys.stderr, e
             sys.exit(1)
 
-        query = make_query_string(sys.argv[argc:])
         with cli.initdb(writable=True) as db:
-            for doc in db.search(query):
-                doc.add_tags(add_tags)
-                doc.remove_tags(remove_tags)
-                doc.sync()
+            cli.tag(db, add_tags, remove_tags, query)
 
     ########################################
     elif cmd in ['dumpterms']:
+        import cli
         prefix = None
         argc = 2
         while True:
@@ -371,6 +439,7 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['maxid']:
+        import cli
         docid = 0
         with cli.initdb() as db:
             for doc in db.search('*'):
@@ -379,12 +448,14 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['count']:
+        import cli
         query = make_query_string(sys.argv[2:], require=False)
         with cli.initdb() as db:
             print db.count(query)
 
     ########################################
     elif cmd in ['export']:
+        import cli
         outdir = sys.argv[2]
         query = make_query_string(sys.argv[3:])
         set_stdout_codec()
@@ -393,12 +464,48 @@ if __name__ == '__main__':
 
     ########################################
     elif cmd in ['restore']:
+        import multiprocessing
+        import cli
+        jobs = multiprocessing.cpu_count()
+        incremental = False
+
+        argc = 2
+        while True:
+            if argc >= len(sys.argv):
+                break
+            elif '--jobs=' in sys.argv[argc]:
+                jobs = int(sys.argv[argc].split('=',1)[1])
+            elif '--incremental' in sys.argv[argc]:
+                incremental = True
+            else:
+                break
+            argc += 1
+
         with cli.initdb(writable=True, create=True, force=True) as db:
-            db.restore(log=True)
+            db.restore(log=True, jobs=jobs, incremental=incremental)
+
+    ########################################
+    elif cmd in ['daemon']:
+        import cli
+        with cli.initdb() as db:
+            try:
+                daemon.Server(db).serve()
+            except daemon.DaemonError as e:
+                print >>sys.stderr, e
+                sys.exit(1)
 
     ########################################
     elif cmd in ['sources']:
+        from source import Sources
+        import cli
+        import database
         sources = Sources()
+        # number of sids for each source in the database, if any
+        try:
+            with database.Database(cli.xapers_root()) as db:
+                counts = db.get_sid_counts()
+        except database.DatabaseError:
+            counts = {}
         w = 0
         for source in sources:
             w = max(len(source.name), w)
@@ -418,10 +525,14 @@ if __name__ == '__main__':
                 path = 'builtin'
             else:
                 path = source.path
-            print format % (name, desc, path)
+            line = format % (name, desc, path)
+            if counts.get(name):
+                line += ' %d in database' % counts[name]
+            print line
 
     ########################################
     elif cmd in ['source2bib', 's2b', 'source2url', 's2u', 'source2file', 's2f']:
+        from source import Sources, SourceError
         outraw = False
 
         argc = 2
@@ -459,6 +570,7 @@ if __name__ == '__main__':
                 continue
 
             elif cmd in ['source2bib', 's2b']:
+                from bibtex import Bibtex
                 try:
                     bibtex = item.fetch_bibtex()
                 except Exception as e:
@@ -478,13 +590,20 @@ if __name__ == '__main__':
             elif cmd in ['source2file', 's2f']:
                 try:
                     name, data = item.fetch_file()
-                    print data
+                    if hasattr(data, 'read'):
+                        import shutil
+                        with data:
+                            shutil.copyfileobj(data, sys.stdout)
+                    else:
+                        print data
                 except Exception as e:
                     print >>sys.stderr, "Could not retrieve file: %s" % e
                     sys.exit(1)
 
     ########################################
     elif cmd in ['scandoc','sd']:
+        from source import Sources
+        from parser import ParseError
         try:
             infile = sys.argv[2]
         except IndexError:
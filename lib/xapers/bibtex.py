@@ -8,6 +8,7 @@ from pybtex.bibtex.utils import split_name_list
 from pybtex.database.input import bibtex as inparser
 from pybtex.database.output import bibtex as outparser
 
+from instrument import timer
 
 def clean_bib_string(string):
     for char in ['{', '}']:
@@ -34,14 +35,15 @@ class Bibtex():
 
         parser = inparser.Parser(encoding='utf-8')
 
-        if os.path.exists(bibtex):
-            bibdata = parser.parse_file(bibtex)
-        else:
-            # StringIO requires unicode input
-            # http://nedbatchelder.com/text/unipain.html
-            assert type(bibtex) is unicode, "Bibtex strings must be unicode"
-            with io.StringIO(bibtex) as stream:
-                bibdata = parser.parse_stream(stream)
+        with timer('bibtex.parse'):
+            if os.path.exists(bibtex):
+                bibdata = parser.parse_file(bibtex)
+            else:
+                # StringIO requires unicode input
+                # http://nedbatchelder.com/text/unipain.html
+                assert type(bibtex) is unicode, "Bibtex strings must be unicode"
+                with io.StringIO(bibtex) as stream:
+                    bibdata = parser.parse_stream(stream)
 
         self.keys = bibdata.entries.keys()
         self.entries = bibdata.entries.values()
@@ -128,7 +130,8 @@ Expects either single path string or Mendeley/Jabref format."""
     def to_file(self, path):
         """Write entry bibtex to file."""
         writer = outparser.Writer(encoding='utf-8')
-        writer.write_file(self._entry2db(), path)
+        with timer('bibtex.write'):
+            writer.write_file(self._entry2db(), path)
 
 ##################################################
 
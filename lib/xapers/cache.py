@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from instrument import count
+##################################################
+
+class FileCache(object):
+    """A size-bounded directory of cached data, keyed by string.
+
+    Once the total size of the cache exceeds 'maxsize' bytes the least
+    recently used entries are evicted.  Entry use is tracked through
+    file modification times.  The cache is best effort: failures to
+    read or write entries are treated as misses.
+
+    """
+
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, key):
+        """Return data for key, or None if not cached."""
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            self.misses += 1
+            count('cache.%s.miss' % os.path.basename(self.path))
+            return None
+        # mark entry as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        count('cache.%s.hit' % os.path.basename(self.path))
+        return data
+
+    def put(self, key, data):
+        """Store data for key."""
+        path = self._entry_path(key)
+        edir = os.path.dirname(path)
+        try:
+            if not os.path.exists(edir):
+                os.makedirs(edir)
+            fd, tmppath = tempfile.mkstemp(dir=edir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmppath, path)
+        except (IOError, OSError):
+            return
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for mtime, size, path in self._entries())
+            else:
+                self._size += len(data)
+            if self._size > self.maxsize:
+                self._evict()
+
+    def _entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    # remove least recently used entries until the cache is back
+    # below 90% of its maximum size
+    def _evict(self):
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, esize, path in entries:
+            if size <= self.maxsize * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= esize
+        self._size = size
+
+##################################################
+
+class TextCache(FileCache):
+    """Cache of text extracted from document files.
+
+    Entries are keyed by a hash of the file content, so unchanged
+    files are never parsed twice, wherever they are located.
+
+    """
+
+    def key_for_data(self, data):
+        return hashlib.sha1(data).hexdigest()
+
+    def key_for_file(self, path):
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                sha.update(chunk)
+        return sha.hexdigest()
+
+##################################################
+
+class QueryCache(FileCache):
+    """Cache of search results.
+
+    Entries are keyed by the normalized query string, the sort order,
+    the source names known to the query parser and the revision of
+    the database it was run against, so any committed change to the
+    database invalidates every entry.  Each entry holds the exact
+    match count, once it has been computed, and the (docid, percent)
+    list of the first matches in order, as many as have been
+    retrieved (up to MAXMATCHES).
+
+    """
+
+    MAXMATCHES = 10000
+
+    def key_for_query(self, query_string, revision, sort=None, sources=[]):
+        query = ' '.join(query_string.split())
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return hashlib.sha1('%d\0%s\0%s\0%s' % (
+            revision, sort or '', ','.join(sources), query)).hexdigest()
+
+    def get_results(self, key):
+        """Return (total, matches) for key, or None if not cached.
+
+        total is None if the match count is not known.
+
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            entry = json.loads(data)
+            matches = [tuple(m) for m in entry['matches'] or []]
+            return entry['total'], matches
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def put_results(self, key, total, matches):
+        """Store the match count (or None) and first matches for key."""
+        self.put(key, json.dumps({'total': total, 'matches': matches},
+                                 separators=(',', ':')))
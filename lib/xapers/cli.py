@@ -20,21 +20,22 @@ Jameson Rollins <jrollins@finestructure.net>
 
 import os
 import sys
-import sets
+import time
 import shutil
-import readline
 
 import database
 from documents import Document
-from source import Sources, SourceError
-from parser import ParseError
-from bibtex import Bibtex, BibtexError
+from source import Sources, SourceError, fetch_items
+from parser import ParseError, parse_files
 
 ############################################################
 
+def xapers_root():
+    return os.getenv('XAPERS_ROOT',
+                     os.path.expanduser(os.path.join('~','.xapers','docs')))
+
 def initdb(writable=False, create=False, force=False):
-    xroot = os.getenv('XAPERS_ROOT',
-                      os.path.expanduser(os.path.join('~','.xapers','docs')))
+    xroot = xapers_root()
     try:
         return database.Database(xroot, writable=writable, create=create, force=force)
     except database.DatabaseUninitializedError as e:
@@ -65,6 +66,7 @@ class Completer:
             return None
 
 def prompt_for_file(infile):
+    import readline
     if infile:
         print >>sys.stderr, 'file: %s' % infile
     else:
@@ -77,6 +79,7 @@ def prompt_for_file(infile):
     return infile
 
 def prompt_for_source(db, sources):
+    import readline
     if sources:
         readline.set_startup_hook(lambda: readline.insert_text(sources[0]))
     elif db:
@@ -91,6 +94,7 @@ def prompt_for_source(db, sources):
     return source
 
 def prompt_for_tags(db, tags):
+    import readline
     # always prompt for tags, and append to initial
     if tags:
         print >>sys.stderr, 'initial tags: %s' % ' '.join(tags)
@@ -115,7 +119,7 @@ def prompt_for_tags(db, tags):
 
 ############################################################
 
-def print_doc_summary(doc):
+def doc_summary(doc):
     docid = doc.docid
     title = doc.get_title()
     if not title:
@@ -126,7 +130,7 @@ def print_doc_summary(doc):
     if not key:
         key = ''
 
-    print "id:%d [%s] {%s} (%s) \"%s\"" % (
+    return "id:%d [%s] {%s} (%s) \"%s\"" % (
         docid,
         ' '.join(sources),
         key,
@@ -134,9 +138,57 @@ def print_doc_summary(doc):
         title,
     )
 
+def print_doc_summary(doc):
+    print doc_summary(doc)
+
+############################################################
+
+class OutputBuffer():
+    """Buffered line output.
+
+    Lines are accumulated and written to the stream in chunks of at
+    least 'size' characters.
+
+    """
+    def __init__(self, stream=None, size=65536):
+        self.stream = stream or sys.stdout
+        self.size = size
+        self.lines = []
+        self.length = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def line(self, string=''):
+        self.lines.append(string)
+        self.length += len(string) + 1
+        if self.length >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.lines:
+            self.lines.append('')
+            self.stream.write('\n'.join(self.lines))
+            self.lines = []
+            self.length = 0
+        self.stream.flush()
+
 ############################################################
 
-def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
+# files fetched from sources are returned either as data or as an open
+# (temporary) file, which is added by path
+def _add_source_file(doc, name, data):
+    if hasattr(data, 'read'):
+        doc.add_file(data.name, name=name)
+    else:
+        doc.add_file_data(name, data)
+
+def add(db, query_string, infile=None, sid=None, tags=None, prompt=False,
+        link=False):
+    from bibtex import BibtexError
 
     doc = None
     bibtex = None
@@ -153,13 +205,13 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     # if query provided, find single doc to update
 
     if query_string:
-        if db.count(query_string) != 1:
+        docs = db.search(query_string)
+        if len(docs) != 1:
             print >>sys.stderr, "Search '%s' did not match a single document." % query_string
             print >>sys.stderr, "Aborting."
             sys.exit(1)
 
-        for doc in db.search(query_string):
-            break
+        doc = docs[0]
 
     ##################################
     # do fancy option prompting
@@ -224,6 +276,9 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
         try:
             print >>sys.stderr, "Retrieving bibtex...",
             bibtex = source.fetch_bibtex()
+            # sources may return byte strings
+            if isinstance(bibtex, str):
+                bibtex = bibtex.decode('utf-8')
             print >>sys.stderr, "done."
         except SourceError as e:
             print >>sys.stderr, "\n"
@@ -244,11 +299,6 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
         print >>sys.stderr, "Must specify source with retrieve file option."
         sys.exit(1)
 
-    if infile and not file_data:
-        with open(infile, 'r') as f:
-            file_data = f.read()
-        file_name = os.path.basename(infile)
-
     ##################################
 
     # if we still don't have a doc, create a new one
@@ -279,7 +329,10 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     if infile:
         try:
             print >>sys.stderr, "Adding file...",
-            doc.add_file_data(file_name, file_data)
+            if file_data is None:
+                doc.add_file(infile, link=link)
+            else:
+                _add_source_file(doc, file_name, file_data)
             print >>sys.stderr, "done."
         except ParseError as e:
             print >>sys.stderr, "\n"
@@ -308,58 +361,195 @@ def add(db, query_string, infile=None, sid=None, tags=None, prompt=False):
     except:
         print >>sys.stderr, "\n"
         raise
+    finally:
+        if hasattr(file_data, 'close'):
+            file_data.close()
 
     print_doc_summary(doc)
     return doc.docid
 
 ############################################
 
-def importbib(db, bibfile, tags=[], overwrite=False):
-    errors = []
+def add_from_list(db, listfile, tags=None, files=False, jobs=8, per_host=2,
+                  retries=3, batch=100):
+    """Add documents for a list of sources, one per line of listfile.
+
+    Bibtex, and files if requested, are fetched concurrently, while
+    documents are written to the database by a single writer in list
+    order.  Sources already in the database are skipped.
 
+    """
     sources = Sources()
+    siddocs = db.get_sid_docids()
+    errors = []
 
-    for entry in sorted(Bibtex(bibfile), key=lambda entry: entry.key):
-        print >>sys.stderr, entry.key
+    items = []
+    skipped = 0
+    with open(listfile, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                item = sources.match_source(line)
+            except SourceError as e:
+                print >>sys.stderr, "%s: %s" % (line, e)
+                errors.append(line)
+                continue
+            if item.sid in siddocs:
+                skipped += 1
+                continue
+            siddocs[item.sid] = None
+            items.append(item)
+
+    start = time.time()
+    count = 0
+
+    # index changes are committed in batches of 'batch' documents
+    with db.batch(batch) as checkpoint:
+        for item, result in fetch_items(items, files=files, jobs=jobs,
+                                        per_host=per_host, retries=retries):
+            if isinstance(result, Exception):
+                print >>sys.stderr, "%s: Could not retrieve source: %s" % (item.sid, result)
+                errors.append(item.sid)
+                continue
+            bibtex, filedata = result
+            # sources may return byte strings
+            if isinstance(bibtex, str):
+                bibtex = bibtex.decode('utf-8')
 
-        try:
-            docs = []
+            try:
+                doc = Document(db)
+                doc.add_bibtex(bibtex)
+                if not doc.get_sids():
+                    doc.add_sid(item.sid)
+                if filedata:
+                    _add_source_file(doc, *filedata)
+                if tags:
+                    doc.add_tags(tags)
+                doc.sync()
+            except Exception as e:
+                print >>sys.stderr, "%s: Could not add document: %s" % (item.sid, e)
+                errors.append(item.sid)
+                continue
+            finally:
+                if filedata and hasattr(filedata[1], 'close'):
+                    filedata[1].close()
+
+            print >>sys.stderr, "%s: id:%d" % (item.sid, doc.docid)
+            count += 1
+            checkpoint()
+
+    elapsed = time.time() - start
+    print >>sys.stderr
+    print >>sys.stderr, "Added %d of %d sources in %.1f s (%.1f sources/sec)." % (
+        count, len(items), elapsed, count / max(elapsed, 1e-6))
+    if skipped:
+        print >>sys.stderr, "Skipped %d sources already in database." % (skipped)
 
-            # check for doc with this bibkey
-            bdoc = db.doc_for_bib(entry.key)
-            if bdoc:
-                docs.append(bdoc)
+    if errors:
+        print >>sys.stderr
+        print >>sys.stderr, "Failed to add %d" % (len(errors)),
+        if len(errors) == 1:
+            print >>sys.stderr, "source:"
+        else:
+            print >>sys.stderr, "sources:"
+        for error in errors:
+            print >>sys.stderr, "  %s" % (error)
+        sys.exit(1)
 
-            # check for known sids
-            for source in sources.scan_bibentry(entry):
-                sdoc = db.doc_for_source(source.sid)
-                # FIXME: why can't we match docs in list?
-                if sdoc and sdoc.docid not in [doc.docid for doc in docs]:
-                    docs.append(sdoc)
+############################################
 
-            if len(docs) == 0:
-                doc = Document(db)
-            elif len(docs) > 0:
-                if len(docs) > 1:
-                    print >>sys.stderr, "  Multiple distinct docs found for entry.  Using first found."
-                doc = docs[0]
-                print >>sys.stderr, "  Updating id:%d..." % (doc.docid)
+def importbib(db, bibfile, tags=[], overwrite=False, batch=1000, jobs=1,
+              link=False):
+    from bibtex import Bibtex, BibtexError
+    errors = []
+
+    sources = Sources()
+
+    # map existing bibtex keys and sids to their documents up front,
+    # with a postlist lookup per key and sid rather than a search per
+    # entry
+    bibdocs = db.get_bib_docids()
+    siddocs = db.get_sid_docids()
 
-            doc.add_bibentry(entry)
+    entries = sorted(Bibtex(bibfile), key=lambda entry: entry.key)
+
+    # extract text from entry files in parallel, in entry order
+    texts = parse_files([entry.get_file() for entry in entries if entry.get_file()],
+                        jobs)
+
+    start = time.time()
+    count = 0
+
+    # index changes are committed in batches of 'batch' entries
+    with db.batch(batch) as checkpoint:
+        for entry in entries:
+            print >>sys.stderr, entry.key
 
             filepath = entry.get_file()
             if filepath:
-                print >>sys.stderr, "  Adding file: %s" % filepath
-                doc.add_file(filepath)
+                path, text = texts.next()
+                if not os.path.isfile(filepath) or not os.access(filepath, os.R_OK):
+                    print >>sys.stderr, "  Warning: skipping missing or unreadable file: %s" % filepath
+                    filepath = None
+                elif isinstance(text, ParseError):
+                    # index the file without its text
+                    print >>sys.stderr, "  Warning: %s" % (text)
+                    text = ''
 
-            doc.add_tags(tags)
+            try:
+                docids = []
 
-            doc.sync()
+                # check for doc with this bibkey
+                if entry.key in bibdocs:
+                    docids.append(bibdocs[entry.key])
 
-        except BibtexError as e:
-            print >>sys.stderr, "  Error processing entry %s: %s" % (entry.key, e)
-            print >>sys.stderr
-            errors.append(entry.key)
+                # check for known sids
+                for source in sources.scan_bibentry(entry):
+                    docid = siddocs.get(source.sid)
+                    if docid and docid not in docids:
+                        docids.append(docid)
+
+                if len(docids) == 0:
+                    doc = Document(db)
+                elif len(docids) > 0:
+                    if len(docids) > 1:
+                        print >>sys.stderr, "  Multiple distinct docs found for entry.  Using first found."
+                    doc = db[docids[0]]
+                    print >>sys.stderr, "  Updating id:%d..." % (doc.docid)
+
+                doc.add_bibentry(entry)
+
+                if filepath:
+                    print >>sys.stderr, "  Adding file: %s" % filepath
+                    doc.add_file(filepath, text=text, link=link)
+
+                doc.add_tags(tags)
+
+                doc.sync()
+
+                bibdocs[entry.key] = doc.docid
+                for sid in doc.get_sids():
+                    siddocs[sid] = doc.docid
+
+            except BibtexError as e:
+                print >>sys.stderr, "  Error processing entry %s: %s" % (entry.key, e)
+                print >>sys.stderr
+                errors.append(entry.key)
+
+            except Exception as e:
+                print >>sys.stderr, "  Error importing entry %s: %s" % (entry.key, e)
+                print >>sys.stderr
+                errors.append(entry.key)
+
+            count += 1
+            checkpoint()
+
+    elapsed = time.time() - start
+    print >>sys.stderr
+    print >>sys.stderr, "Processed %d entries in %.1f s (%.1f entries/sec)." % (
+        count, elapsed, count / max(elapsed, 1e-6))
 
     if errors:
         print >>sys.stderr
@@ -377,57 +567,212 @@ def importbib(db, bibfile, tags=[], overwrite=False):
 
 ############################################
 
-def search(db, query_string, oformat='summary', limit=None):
+def make_query_string(terms, require=True):
+    """Combine a list of terms in to a query string.
+
+    Terms are joined with spaces, so that simple queries don't have
+    to be quoted at the shell level.  If there are no terms the query
+    is '*', or if 'require' is True ValueError is raised.
+
+    """
+    string = str.join(' ', terms)
+    if string == '':
+        if require:
+            raise ValueError("Must specify a search term.")
+        string = '*'
+    return string
+
+def parse_tag_args(args):
+    """Parse tag command arguments, '+<tag>|-<tag> [...] [--] <search-terms>'.
+
+    Returns an (add_tags, remove_tags, query_string) tuple.  Raises
+    ValueError if the arguments are invalid.
+
+    """
+    add_tags = []
+    remove_tags = []
+
+    argc = 0
+    for arg in args:
+        if arg == '--':
+            argc += 1
+            break
+        if arg[0] == '+':
+            add_tags.append(arg[1:])
+        elif arg[0] == '-':
+            remove_tags.append(arg[1:])
+        else:
+            break
+        argc += 1
+
+    if not add_tags and not remove_tags:
+        raise ValueError("Must specify tags to add or remove.")
+
+    if '' in add_tags:
+        raise ValueError("Null tags not allowed.")
+
+    query_string = make_query_string(args[argc:])
+
+    return add_tags, remove_tags, query_string
+
+def tag(db, add_tags, remove_tags, query_string):
+    """Add and remove tags on all documents matching query_string.
+
+    Returns the number of matching documents.
+
+    """
+    count = 0
+    for doc in db.search(query_string):
+        doc.add_tags(add_tags)
+        doc.remove_tags(remove_tags)
+        # a no-op for documents whose tags did not change
+        doc.sync()
+        count += 1
+    return count
+
+def tag_batch(db, infile):
+    """Apply tag operations read from infile, one per line.
+
+    Lines have the same form as the arguments to the tag command,
+    '+<tag>|-<tag> [...] [--] <search-terms>', split as by a shell.
+    Blank lines and lines starting with '#' are ignored.  All lines
+    are parsed before any are applied, and all operations are then
+    applied in order in a single transaction.
+
+    """
+    import shlex
+
+    ops = []
+    for lineno, line in enumerate(infile, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            ops.append(parse_tag_args(shlex.split(line)))
+        except ValueError as e:
+            print >>sys.stderr, "Line %d: %s" % (lineno, e)
+            sys.exit(1)
+
+    start = time.time()
+    count = 0
+    # all in one transaction
+    with db.batch(None):
+        for add_tags, remove_tags, query_string in ops:
+            count += tag(db, add_tags, remove_tags, query_string)
+
+    elapsed = time.time() - start
+    print >>sys.stderr, "Applied %d tag operations to %d matching documents in %.1f s (%.1f operations/sec)." % (
+        len(ops), count, elapsed, len(ops) / max(elapsed, 1e-6))
+
+############################################
+
+OUTPUT_FORMATS = ['summary', 'bibtex', 'tags', 'sources', 'keys', 'files', 'facets']
+
+FACETS = ['tag', 'source', 'year']
+
+def parse_search_args(args):
+    """Parse search command arguments, '[options...] <search-terms>'.
+
+    Returns a (query_string, options) tuple, where options are the
+    keyword arguments for search().  Raises ValueError if the
+    arguments are invalid.
+
+    """
+    options = {
+        'oformat': 'summary',
+        'limit': 0,
+        'offset': 0,
+        'facets': FACETS,
+        'sort': None,
+        }
+
+    argc = 0
+    while argc < len(args):
+        if '--output=' in args[argc]:
+            options['oformat'] = args[argc].split('=')[1]
+        elif '--limit=' in args[argc]:
+            options['limit'] = int(args[argc].split('=')[1])
+        elif '--offset=' in args[argc]:
+            options['offset'] = int(args[argc].split('=')[1])
+        elif '--facets=' in args[argc]:
+            options['facets'] = args[argc].split('=',1)[1].split(',')
+        elif '--sort=' in args[argc]:
+            options['sort'] = args[argc].split('=',1)[1]
+        else:
+            break
+        argc += 1
+
+    if options['oformat'] not in OUTPUT_FORMATS:
+        raise ValueError("Unknown output format.")
+
+    if options['sort'] and options['sort'] not in database.Database.SORT_ORDERS:
+        raise ValueError("Unknown sort order.")
+
+    return make_query_string(args[argc:]), options
+
+def search(db, query_string, oformat='summary', limit=None, offset=0,
+           facets=FACETS, sort=None):
+    # results are streamed out as their mset windows are retrieved
+    with OutputBuffer() as out:
+        if oformat == 'facets':
+            _search_facets(db, query_string, out, facets)
+        else:
+            _search(db, query_string, out, oformat, limit, offset, sort)
+
+def _search_facets(db, query_string, out, names):
+    try:
+        facets = db.facets(query_string, names)
+    except database.DatabaseError as e:
+        print >>sys.stderr, e
+        sys.exit(1)
+    for name in names:
+        for value, count in facets[name]:
+            out.line("%s:%s %d" % (name, value, count))
+
+def _search(db, query_string, out, oformat, limit, offset, sort):
     if query_string == '*' and oformat in ['tags','sources','keys']:
         if oformat == 'tags':
             for tag in db.term_iter('tag'):
-                print tag
+                out.line(tag)
         elif oformat == 'sources':
             for source in db.get_sids():
-                print source
+                out.line(source)
         elif oformat == 'keys':
             for key in db.term_iter('key'):
-                print key
+                out.line(key)
         return
 
-    otags = set([])
-    osources = set([])
-    okeys = set([])
+    # tags and sources are collected from the matches' term lists
+    if oformat in ['tags', 'sources']:
+        name = {'tags': 'tag', 'sources': 'sid'}[oformat]
+        for value in sorted(db.match_terms(query_string, name, limit=limit,
+                                           offset=offset, sort=sort)):
+            out.line(value)
+        return
 
-    for doc in db.search(query_string, limit=limit):
+    docs = db.search(query_string, limit=limit, offset=offset, pagesize=1000,
+                     sort=sort)
+    for doc in docs:
         if oformat in ['summary']:
-            print_doc_summary(doc)
-            continue
+            out.line(doc_summary(doc))
 
         elif oformat in ['file','files']:
             for path in doc.get_fullpaths():
-                print "%s" % (path)
-            continue
+                out.line(path)
 
         elif oformat == 'bibtex':
             bibtex = doc.get_bibtex()
             if not bibtex:
+                out.flush()
                 print >>sys.stderr, "No bibtex for doc id:%d." % doc.docid
             else:
-                print bibtex
-                print
-            continue
+                out.line(bibtex)
+                out.line()
 
-        if oformat == 'tags':
-            otags = otags | set(doc.get_tags())
-        elif oformat == 'sources':
-            osources = osources | set(doc.get_sids())
         elif oformat == 'keys':
             key = doc.get_key()
             if key:
-                print key
-
-    if oformat == 'tags':
-        for tag in otags:
-            print tag
-    elif oformat == 'sources':
-        for source in osources:
-            print source
+                out.line(key)
 
 ############################################
 
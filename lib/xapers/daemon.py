@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+
+import instrument
+
+##################################################
+
+# commands that can be served by a running daemon
+COMMANDS = ['search', 's', 'bibtex', 'bib', 'b', 'count', 'tag', 't']
+
+def serves(argv):
+    """True if the command in argv can be served by a daemon."""
+    if not argv or argv[0] not in COMMANDS:
+        return False
+    # batch tagging reads the client's stdin or files
+    if argv[0] in ['tag', 't'] and argv[1:2] and argv[1].startswith('--batch'):
+        return False
+    return True
+
+def environment():
+    """The xapers settings in the environment.
+
+    All XAPERS_* variables other than those selecting the daemon.
+    Commands are only served if the client's settings match the
+    daemon's, since many are read once per process.
+
+    """
+    return dict([(name, value) for name, value in os.environ.items()
+                 if name.startswith('XAPERS_')
+                 and name not in ['XAPERS_ROOT', 'XAPERS_NO_DAEMON']])
+
+def xapers_root():
+    return os.getenv('XAPERS_ROOT',
+                     os.path.expanduser(os.path.join('~','.xapers','docs')))
+
+def socket_path(root):
+    return os.path.join(root, '.xapers', 'daemon.sock')
+
+class DaemonError(Exception):
+    pass
+
+# response status for requests the daemon will not serve
+DECLINED = -1
+
+# seconds the daemon waits on a stalled client, and a client on a
+# daemon that sends nothing (commands producing no output for this
+# long are given up on)
+SERVER_TIMEOUT = 60
+CLIENT_TIMEOUT = 600
+
+##################################################
+# client
+
+# read exactly size bytes from a socket file
+def _read(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        raise DaemonError("Connection to xapers daemon lost.")
+    return data
+
+def call(argv, root=None):
+    """Run a command through a running daemon.
+
+    The command output is written to stdout and stderr, and its exit
+    status is returned.  Returns None if no daemon is running, or if
+    it declined the command because its environment differs, in
+    which case the command should be run directly.
+
+    """
+    path = socket_path(root or xapers_root())
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CLIENT_TIMEOUT)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in [errno.ENOENT, errno.ECONNREFUSED]:
+            return None
+        raise
+    try:
+        sock.sendall(json.dumps({'argv': argv, 'env': environment()}) + '\n')
+        f = sock.makefile('rb')
+        streams = {'o': sys.stdout, 'e': sys.stderr}
+        # output is written as it arrives, until the exit status
+        while True:
+            header = f.readline().split()
+            if len(header) != 2 or header[0] not in ['o', 'e', 'x'] \
+               or not header[1].lstrip('-').isdigit():
+                raise DaemonError("Invalid response from xapers daemon.")
+            if header[0] == 'x':
+                status = int(header[1])
+                break
+            streams[header[0]].write(_read(f, int(header[1])))
+        f.close()
+    except socket.timeout:
+        raise DaemonError("Timed out waiting for xapers daemon.")
+    finally:
+        sock.close()
+    if status == DECLINED:
+        return None
+    return status
+
+##################################################
+# server
+
+class Terminated(BaseException):
+    """Raised when the daemon is asked to terminate.
+
+    Not an Exception, so that commands do not catch it.
+
+    """
+
+def _terminate(signum, frame):
+    raise Terminated()
+
+class _Stream(object):
+    """File object sending what is written to a client as it is written.
+
+    Each write is sent as a '<kind> <length>' line followed by the
+    data, kind being 'o' for stdout and 'e' for stderr.
+
+    """
+
+    def __init__(self, conn, kind):
+        self.conn = conn
+        self.kind = kind
+        self.softspace = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if data:
+            self.conn.sendall('%s %d\n%s' % (self.kind, len(data), data))
+
+    def flush(self):
+        pass
+
+class Server(object):
+    """Serve xapers commands over a Unix domain socket.
+
+    The database is kept open between requests, so commands do not
+    pay for interpreter startup, module imports and database setup.
+    Requests are handled one at a time, so writes are serialized.
+
+    Each request is a single line of json, {"argv": [<cmd>, <args>...],
+    "env": {<name>: <value>, ...}}.  The command output is streamed
+    back as it is written, in chunks framed as by _Stream, and the
+    response ends with an 'x <status>' line.  If the xapers
+    environment of the request differs from the daemon's (see
+    environment()), the status is DECLINED and there is no output.
+
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.path = socket_path(db.root)
+        self.handlers = {
+            'search': self.search,
+            's': self.search,
+            'bibtex': self.bibtex,
+            'bib': self.bibtex,
+            'b': self.bibtex,
+            'count': self.count,
+            'tag': self.tag,
+            't': self.tag,
+            }
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.path):
+            try:
+                sock.connect(self.path)
+            except socket.error:
+                # stale socket from a daemon that did not exit cleanly
+                os.remove(self.path)
+            else:
+                sock.close()
+                raise DaemonError("Xapers daemon already running (%s)." % self.path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # the socket is only accessible by the user from the start
+        umask = os.umask(0177)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        return sock
+
+    def serve(self):
+        """Serve requests until interrupted or terminated."""
+        sock = self._bind()
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            while True:
+                conn, addr = sock.accept()
+                # a stalled client must not hold up the daemon
+                conn.settimeout(SERVER_TIMEOUT)
+                try:
+                    self._handle(conn)
+                except (socket.error, DaemonError):
+                    pass
+                finally:
+                    conn.close()
+        except Terminated:
+            pass
+        finally:
+            sock.close()
+            os.remove(self.path)
+
+    def _handle(self, conn):
+        f = conn.makefile('rb')
+        try:
+            request = json.loads(f.readline())
+            argv = request['argv']
+            env = request.get('env', {})
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise DaemonError("Invalid request.")
+        finally:
+            f.close()
+        if env != environment():
+            conn.sendall('x %d\n' % DECLINED)
+            return
+        argv = [arg.encode('utf-8') for arg in argv]
+        status = self.run(argv, _Stream(conn, 'o'), _Stream(conn, 'e'))
+        conn.sendall('x %d\n' % status)
+
+    def run(self, argv, out, err):
+        """Run a command writing to out and err, returning its status.
+
+        Errors writing to the client (socket.error) and termination
+        of the daemon are raised, rather than reported as the status
+        of the command.
+
+        """
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = out
+        sys.stderr = err
+        status = 0
+        try:
+            if not argv or argv[0] not in self.handlers:
+                print >>sys.stderr, "Command not supported by xapers daemon."
+                sys.exit(1)
+            instrument.reset()
+            # pick up changes made outside the daemon
+            self.db.reopen()
+            self.handlers[argv[0]](argv[1:])
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print >>sys.stderr, e.code
+                status = 1
+        except socket.error:
+            raise
+        except Exception as e:
+            print >>sys.stderr, "Error: %s" % e
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        if instrument.ENABLED:
+            instrument.report(' '.join(argv), err)
+        return status
+
+    ########################################
+    # command handlers, mirroring the command line interface
+
+    # parse arguments with one of the cli parsers, exiting with the
+    # error message as the command line would
+    def _parse(self, parser, *args):
+        try:
+            return parser(*args)
+        except ValueError as e:
+            print >>sys.stderr, e
+            sys.exit(1)
+
+    def search(self, args):
+        import cli
+        query, options = self._parse(cli.parse_search_args, args)
+        cli.search(self.db, query, **options)
+
+    def bibtex(self, args):
+        import cli
+        query = self._parse(cli.make_query_string, args)
+        cli.search(self.db, query, oformat='bibtex')
+
+    def count(self, args):
+        import cli
+        query = self._parse(cli.make_query_string, args, False)
+        print self.db.count(query)
+
+    def tag(self, args):
+        import cli
+        add_tags, remove_tags, query = self._parse(cli.parse_tag_args, args)
+        # the writable database is only held for the duration of the
+        # request, so other xapers processes can still write
+        with cli.initdb(writable=True) as db:
+            cli.tag(db, add_tags, remove_tags, query)
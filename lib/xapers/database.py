@@ -19,11 +19,17 @@ Jameson Rollins <jrollins@finestructure.net>
 """
 
 import os
+import re
 import sys
+import time
 import xapian
+import contextlib
 
 from source import Sources
-from documents import Documents, Document
+from parser import ParseError, parse_files, set_text_cache
+from cache import TextCache, QueryCache
+from documents import Documents, Document, docdir_fingerprint, docdir_times
+from instrument import timer, timed
 
 # FIXME: add db schema documentation
 
@@ -47,6 +53,73 @@ class DatabaseLockError(DatabaseError):
 
 ##################################################
 
+class DateRangeProcessor(xapian.ValueRangeProcessor):
+    """Range processor for dates stored as serialised unix times.
+
+    Handles ranges such as 'added:2014-01-01..2014-06-30' and
+    'modified:7d..'.  Range ends are either absolute local dates,
+    YYYY-MM-DD with an optional THH:MM[:SS] time, or times relative
+    to now, N followed by h, d, w or y for hours, days, weeks or
+    years ago.  Absolute end dates include the whole day or minute
+    they name.
+
+    """
+
+    DATE_FORMATS = [
+        ('%Y-%m-%d', 86400),
+        ('%Y-%m-%dT%H:%M', 60),
+        ('%Y-%m-%dT%H:%M:%S', 1),
+        ]
+
+    RELATIVE_RE = re.compile(r'^(\d+)([hdwy])$')
+
+    RELATIVE_UNITS = {
+        'h': 3600,
+        'd': 86400,
+        'w': 7 * 86400,
+        'y': 365 * 86400,
+        }
+
+    def __init__(self, slot, prefix):
+        xapian.ValueRangeProcessor.__init__(self)
+        self.slot = slot
+        self.prefix = prefix
+
+    # return the unix time for a range end, or None if it is not a
+    # valid date
+    def _parse(self, string, end=False):
+        match = self.RELATIVE_RE.match(string)
+        if match:
+            count, unit = match.groups()
+            return time.time() - int(count) * self.RELATIVE_UNITS[unit]
+        for fmt, resolution in self.DATE_FORMATS:
+            try:
+                t = time.mktime(time.strptime(string, fmt))
+            except ValueError:
+                continue
+            if end:
+                t += resolution - 0.001
+            return t
+        return None
+
+    def __call__(self, begin, end):
+        if not begin.startswith(self.prefix):
+            return (xapian.BAD_VALUENO, begin, end)
+        begin = begin[len(self.prefix):]
+        if begin:
+            t = self._parse(begin)
+            if t is None:
+                return (xapian.BAD_VALUENO, begin, end)
+            begin = xapian.sortable_serialise(t)
+        if end:
+            t = self._parse(end, end=True)
+            if t is None:
+                return (xapian.BAD_VALUENO, begin, end)
+            end = xapian.sortable_serialise(t)
+        return (self.slot, begin, end)
+
+##################################################
+
 class Database():
     """Represents a Xapers database"""
 
@@ -56,6 +129,9 @@ class Database():
         #'url': 'U',
         'file': 'P',
 
+        # all source ids as 'source:oid', one ordered range
+        'sid': 'XSID|',
+
         # FIXME: use this for doc mime type
         'type': 'T',
         }
@@ -82,10 +158,44 @@ class Database():
         'y': 0,
         }
 
-    # FIXME: need to set the following value fields:
-    # publication date
-    # added date
-    # modified date
+    # value slots holding document data for fast retrieval
+    VALUE_SLOT = {
+        # display fields (title, authors, year, key, journal, urls)
+        # as compact json, so listings don't need to parse bibtex
+        'summary': 1,
+        # fingerprint of the docdir contents when last synced
+        'fingerprint': 2,
+        # newline separated tags and source names, for facet counts
+        'tags': 3,
+        'sources': 4,
+        # sort keys: lowercased title and first author, and the
+        # serialised times the document was added and last modified
+        'title': 5,
+        'author': 6,
+        'added': 7,
+        'modified': 8,
+        }
+
+    # facets that can be counted over search results, and the value
+    # slots holding them
+    FACET_SLOT = {
+        'tag': VALUE_SLOT['tags'],
+        'source': VALUE_SLOT['sources'],
+        'year': NUMBER_VALUE_FACET['year'],
+        }
+
+    # orders for search results, other than the default relevance
+    # order: the value slot sorted on, and whether higher values come
+    # first
+    SORT_ORDER = {
+        'year': (NUMBER_VALUE_FACET['year'], True),
+        'added': (VALUE_SLOT['added'], True),
+        'modified': (VALUE_SLOT['modified'], True),
+        'title': (VALUE_SLOT['title'], False),
+        'author': (VALUE_SLOT['author'], False),
+        }
+
+    SORT_ORDERS = ['relevance', 'year', 'added', 'modified', 'title', 'author']
 
     # FIXME: need database version
 
@@ -101,9 +211,25 @@ class Database():
         if name in self.NUMBER_VALUE_FACET:
             return self.NUMBER_VALUE_FACET[name]
 
+    def _find_slot(self, name):
+        if name in self.VALUE_SLOT:
+            return self.VALUE_SLOT[name]
+
     def _make_source_prefix(self, source):
         return 'X%s|' % (source.upper())
 
+    # metadata key marking that every document carries its sid index
+    # terms (set on new databases and by full restores)
+    SID_INDEX_KEY = 'xapers_sid_index'
+
+    # metadata key marking that every document carries its tag and
+    # source facet values (set on new databases and by full restores)
+    FACET_VALUES_KEY = 'xapers_facet_values'
+
+    # facets stored as values only since FACET_VALUES_KEY, and the
+    # term prefixes they can be counted from otherwise
+    TERM_FACETS = ['tag', 'source']
+
     ########################################
 
     def __init__(self, root, writable=False, create=False, force=False):
@@ -112,6 +238,7 @@ class Database():
 
         # xapers db directory
         xapers_path = os.path.join(self.root, '.xapers')
+        self.xapers_path = xapers_path
 
         # xapes directory initialization
         if not os.path.exists(xapers_path):
@@ -128,6 +255,7 @@ class Database():
 
         # the Xapian db
         xapian_path = os.path.join(xapers_path, 'xapian')
+        self.writable = writable
         if writable:
             try:
                 self.xapian = xapian.WritableDatabase(xapian_path, xapian.DB_CREATE_OR_OPEN)
@@ -136,41 +264,97 @@ class Database():
         else:
             self.xapian = xapian.Database(xapian_path)
 
-        stemmer = xapian.Stem("english")
-
+        # an empty database has a trivially complete sid index
+        if writable and self.xapian.get_doccount() == 0:
+            self.xapian.set_metadata(self.SID_INDEX_KEY, '1')
+            self.xapian.set_metadata(self.FACET_VALUES_KEY, '1')
+
+        # cache of text extracted from document files, bounded to
+        # XAPERS_TEXT_CACHE_SIZE MB (0 disables)
+        cache_size = int(os.getenv('XAPERS_TEXT_CACHE_SIZE', 512))
+        if cache_size > 0:
+            set_text_cache(TextCache(os.path.join(xapers_path, 'text'),
+                                     cache_size * 1024 * 1024))
+        else:
+            set_text_cache(None)
+
+        # cache of search results, bounded to XAPERS_QUERY_CACHE_SIZE
+        # MB (0 disables).  entries are keyed by database revision,
+        # which only exists for committed, read-only views.
+        self.query_cache = None
+        cache_size = int(os.getenv('XAPERS_QUERY_CACHE_SIZE', 32))
+        if cache_size > 0 and not writable \
+           and hasattr(self.xapian, 'get_revision'):
+            self.query_cache = QueryCache(os.path.join(xapers_path, 'queries'),
+                                          cache_size * 1024 * 1024)
+
+        # the term generator, query parser and source prefixes are
+        # only built when first needed, since many commands never
+        # index or parse queries
+        self._term_gen = None
+        self._query_parser = None
+        self._source_prefixes_map = None
+
+    @property
+    def term_gen(self):
         # The Xapian TermGenerator
         # http://trac.xapian.org/wiki/FAQ/TermGenerator
-        self.term_gen = xapian.TermGenerator()
-        self.term_gen.set_stemmer(stemmer)
+        if self._term_gen is None:
+            self._term_gen = xapian.TermGenerator()
+            self._term_gen.set_stemmer(xapian.Stem("english"))
+        return self._term_gen
+
+    @property
+    def _source_prefixes(self):
+        # map of source names to term prefixes, for all sources that
+        # have documents in the database plus all known source modules
+        if self._source_prefixes_map is None:
+            names = set(self.term_iter('source'))
+            names.update([source.name for source in Sources()])
+            self._source_prefixes_map = dict(
+                [(name, self._make_source_prefix(name)) for name in names])
+        return self._source_prefixes_map
+
+    @property
+    def query_parser(self):
+        if self._query_parser is not None:
+            return self._query_parser
 
         # The Xapian QueryParser
-        self.query_parser = xapian.QueryParser()
-        self.query_parser.set_database(self.xapian)
-        self.query_parser.set_stemmer(stemmer)
-        self.query_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
-        self.query_parser.set_default_op(xapian.Query.OP_AND)
+        query_parser = xapian.QueryParser()
+        query_parser.set_database(self.xapian)
+        query_parser.set_stemmer(xapian.Stem("english"))
+        query_parser.set_stemming_strategy(xapian.QueryParser.STEM_SOME)
+        query_parser.set_default_op(xapian.Query.OP_AND)
 
         # add boolean internal prefixes
         for name, prefix in self.BOOLEAN_PREFIX_EXTERNAL.iteritems():
-            self.query_parser.add_boolean_prefix(name, prefix)
+            query_parser.add_boolean_prefix(name, prefix)
 
         # add probabalistic prefixes
         for name, prefix in self.PROBABILISTIC_PREFIX.iteritems():
-            self.query_parser.add_prefix(name, prefix)
+            query_parser.add_prefix(name, prefix)
 
         # add value facets
         for name, facet in self.NUMBER_VALUE_FACET.iteritems():
-            self.query_parser.add_valuerangeprocessor(
+            query_parser.add_valuerangeprocessor(
                 xapian.NumberValueRangeProcessor(facet, name+':')
                 )
 
-        # register known source prefixes
-        # FIXME: can we do this by just finding all XSOURCE terms in
-        #        db?  Would elliminate dependence on source modules at
-        #        search time.
-        for source in Sources():
-            name = source.name
-            self.query_parser.add_boolean_prefix(name, self._make_source_prefix(name))
+        # add date ranges.  the parser does not hold references to
+        # python range processors, so they are kept here.
+        self._range_processors = []
+        for name in ['added', 'modified']:
+            processor = DateRangeProcessor(self._find_slot(name), name+':')
+            query_parser.add_valuerangeprocessor(processor)
+            self._range_processors.append(processor)
+
+        # register source prefixes
+        for name, prefix in self._source_prefixes.iteritems():
+            query_parser.add_boolean_prefix(name, prefix)
+
+        self._query_parser = query_parser
+        return self._query_parser
 
     def __enter__(self):
         return self
@@ -233,26 +417,84 @@ class Database():
                 prefix = name
         return self._term_iter(prefix)
 
-    def get_sids(self):
-        """Get all sources in database."""
-        sids = []
-        # FIXME: do this more efficiently
+    def _has_sid_index(self):
+        return self.xapian.get_metadata(self.SID_INDEX_KEY) == '1'
+
+    def _has_facet_values(self):
+        return self.xapian.get_metadata(self.FACET_VALUES_KEY) == '1'
+
+    # iterate over all sids, scanning each source prefix in turn for
+    # databases predating the sid index
+    def _iter_sids_by_source(self):
         for source in self.term_iter('source'):
             for oid in self._term_iter(self._make_source_prefix(source)):
-                sids.append('%s:%s' % (source, oid))
-        return sids
+                yield '%s:%s' % (source, oid)
+
+    def get_sids(self, prefix=''):
+        """Get all sources in database.
+
+        If a prefix is provided, only sids starting with it are
+        returned (e.g. 'arxiv:' for all arxiv sids).
+
+        """
+        if self._has_sid_index():
+            sprefix = self._find_prefix('sid')
+            return [prefix + sid for sid in self._term_iter(sprefix + prefix)]
+        return [sid for sid in self._iter_sids_by_source()
+                if sid.startswith(prefix)]
+
+    def get_sid_counts(self):
+        """Get a dict mapping source names to number of sids in database."""
+        counts = {}
+        if self._has_sid_index():
+            sids = self._term_iter(self._find_prefix('sid'))
+        else:
+            sids = self._iter_sids_by_source()
+        for sid in sids:
+            source = sid.split(':', 1)[0]
+            counts[source] = counts.get(source, 0) + 1
+        return counts
+
+    # return a dict mapping all terms for prefix to the id of the
+    # first document indexed by them.  the term range is walked once,
+    # but each term's postlist is opened to read its first docid, so
+    # this costs one postlist lookup per term (though no Enquire).
+    def _term_docids(self, prefix):
+        docids = {}
+        for term in self._term_iter(prefix):
+            for post in self.xapian.postlist(prefix + term):
+                docids[term] = post.docid
+                break
+        return docids
+
+    def get_bib_docids(self):
+        """Get a dict mapping bibtex keys to document ids."""
+        return self._term_docids(self._find_prefix('key'))
+
+    def get_sid_docids(self):
+        """Get a dict mapping source ids to document ids."""
+        if self._has_sid_index():
+            return self._term_docids(self._find_prefix('sid'))
+        docids = {}
+        for source in self.term_iter('source'):
+            prefix = self._make_source_prefix(source)
+            for oid, docid in self._term_docids(prefix).iteritems():
+                docids['%s:%s' % (source, oid)] = docid
+        return docids
 
     ########################################
 
-    # search for documents based on query string
-    def _search(self, query_string, limit=None):
+    # build an enquire for a query string, with results in the given
+    # sort order
+    def _enquire(self, query_string, sort=None):
         enquire = xapian.Enquire(self.xapian)
 
         if query_string == "*":
             query = xapian.Query.MatchAll
         else:
             # parse the query string to produce a Xapian::Query object.
-            query = self.query_parser.parse_query(query_string)
+            with timer('xapian.parse_query'):
+                query = self.query_parser.parse_query(query_string)
 
         if os.getenv('XAPERS_DEBUG_QUERY'):
             print >>sys.stderr, "query string:", query_string
@@ -261,31 +503,321 @@ class Database():
         # FIXME: need to catch Xapian::Error when using enquire
         enquire.set_query(query)
 
-        # set order of returned docs as newest first
-        # FIXME: make this user specifiable
+        # documents that otherwise rank equally are returned newest
+        # first
         enquire.set_docid_order(xapian.Enquire.DESCENDING)
 
-        if limit:
-            mset = enquire.get_mset(0, limit)
+        # sort on value slots inside the matcher, so only as many
+        # documents as requested are fetched
+        if sort and sort != 'relevance':
+            if sort not in self.SORT_ORDER:
+                raise DatabaseError("Unknown sort order '%s'." % sort)
+            slot, reverse = self.SORT_ORDER[sort]
+            enquire.set_sort_by_value_then_relevance(slot, reverse)
+
+        return enquire
+
+    # date ranges relative to now, whose results change over time
+    RELATIVE_DATE_RE = re.compile(r'\b(added|modified):\S*\d[hdwy]\b')
+
+    # true if results for a query string can be cached
+    def _cacheable(self, query_string):
+        return self.query_cache is not None \
+            and not self.RELATIVE_DATE_RE.search(query_string)
+
+    # single boolean term query, e.g. 'tag:new'.  capitalized values
+    # and ranges are left to the query parser.
+    BOOLEAN_TERM_RE = re.compile(r'^([a-z]+):([^\sA-Z()"]+)$')
+
+    # return the term for a query string consisting of a single
+    # boolean prefixed term, or None
+    def _boolean_term(self, query_string):
+        match = self.BOOLEAN_TERM_RE.match(query_string)
+        if not match:
+            return None
+        name, value = match.groups()
+        if '..' in value:
+            return None
+        if name in self.BOOLEAN_PREFIX_EXTERNAL:
+            prefix = self.BOOLEAN_PREFIX_EXTERNAL[name]
+        elif name in self._source_prefixes:
+            prefix = self._source_prefixes[name]
         else:
-            mset = enquire.get_mset(0, self.xapian.get_doccount())
+            return None
+        return prefix + value
+
+    # return the exact number of matches for a query string if it can
+    # be found without running the matcher, or None
+    def _term_count(self, query_string):
+        if query_string == '*':
+            return self.xapian.get_doccount()
+        term = self._boolean_term(query_string)
+        if term:
+            return self.xapian.get_termfreq(term)
+        return None
+
+    # return the query cache key for a query string.  the source
+    # names are part of the key, since they determine how source
+    # prefixed terms are parsed.
+    def _cache_key(self, query_string, sort=None):
+        return self.query_cache.key_for_query(
+            query_string, self.xapian.get_revision(), sort,
+            sources=sorted(self._source_prefixes))
+
+    # return (total, matches) cached for a key, or (None, []) on a
+    # miss.  total is None if the exact count is not known yet, and
+    # matches holds the first (docid, percent) matches, in order.
+    def _cached_results(self, key):
+        cache = self.query_cache
+        results = cache.get_results(key)
+        if os.getenv('XAPERS_DEBUG_QUERY'):
+            print >>sys.stderr, "query cache %s (%d hits, %d misses)" % (
+                results is None and 'miss' or 'hit', cache.hits, cache.misses)
+        if results is None:
+            return None, []
+        return results
+
+    def search(self, query_string, limit=0, offset=0, pagesize=None, sort=None):
+        """Search for documents in the database.
+
+        Returns a Documents object.  Matches are retrieved lazily, in
+        windows of 'pagesize' documents, starting 'offset' matches
+        into the result set.  If 'limit' is non-zero at most 'limit'
+        documents are returned.  The length of the returned Documents
+        is the exact number of matches, which is computed along with
+        the first window so the query is only evaluated once.
 
-        return mset
+        On a writable database all matches are retrieved in a single
+        window, since documents modified while iterating may otherwise
+        shift the windows still to be fetched.
 
-    def search(self, query_string, limit=0):
-        """Search for documents in the database."""
-        mset = self._search(query_string, limit)
-        return Documents(self, mset)
+        On a read-only database the matches up to the end of the
+        first window are served from the query cache, and only those
+        are retrieved and cached on a miss.
 
-    def count(self, query_string):
-        """Count documents matching search terms."""
-        return self._search(query_string).get_matches_estimated()
+        'sort' is one of SORT_ORDERS.  By default, and for
+        'relevance', documents are ordered by relevance, newest first.
+
+        """
+        if sort and sort != 'relevance' and sort not in self.SORT_ORDER:
+            raise DatabaseError("Unknown sort order '%s'." % sort)
+        total = self._term_count(query_string)
+        enquire = self._enquire(query_string, sort)
+        if self.writable:
+            pagesize = max(self.xapian.get_doccount(), 1)
+        matches = None
+        if total is None and self._cacheable(query_string):
+            total, matches = self._cached_window(
+                enquire, self._cache_key(query_string, sort),
+                offset + (limit or pagesize or Documents.PAGESIZE))
+        return Documents(self, enquire,
+                         offset=offset, limit=limit, pagesize=pagesize,
+                         total=total, matches=matches)
+
+    # return (total, matches) for the first 'size' matches of an
+    # enquire from the query cache.  if fewer are cached, only the
+    # first 'size' matches are retrieved (the match count is not
+    # forced to be exact), and cached in place of the shorter list.
+    def _cached_window(self, enquire, key, size):
+        cache = self.query_cache
+        total, matches = self._cached_results(key)
+        size = min(size, cache.MAXMATCHES)
+        if len(matches) >= size or (total is not None and len(matches) >= total):
+            return total, matches
+        with timer('xapian.get_mset'):
+            mset = enquire.get_mset(0, size)
+        matches = [(m.docid, m.percent) for m in mset]
+        if total is None \
+           and mset.get_matches_lower_bound() == mset.get_matches_upper_bound():
+            total = mset.get_matches_estimated()
+        cache.put_results(key, total, matches)
+        return total, matches
+
+    def iter_matches(self, query_string, sort=None, offset=0, pagesize=100,
+                     maxpagesize=1000):
+        """Iterate over the matches of a query, a page at a time.
+
+        Yields lists of (docid, percent) tuples, in result order,
+        starting 'offset' matches into the result set.  The first page
+        holds up to 'pagesize' matches, and each later page twice as
+        many as the one before, up to 'maxpagesize', so that the first
+        results are available quickly and long result sets are still
+        retrieved in few passes.
+
+        """
+        enquire = self._enquire(query_string, sort)
+        start = offset
+        while True:
+            with timer('xapian.get_mset'):
+                mset = enquire.get_mset(start, pagesize)
+            matches = [(m.docid, m.percent) for m in mset]
+            if matches:
+                yield matches
+            if len(matches) < pagesize:
+                return
+            start += pagesize
+            pagesize = min(pagesize * 2, maxpagesize)
+
+    # iterate over the terms with prefix in the term list of a
+    # document, with the prefix removed
+    def _docid_terms(self, docid, prefix):
+        plen = len(prefix)
+        termlist = self.xapian.termlist(docid)
+        item = termlist.skip_to(prefix)
+        while item.term.startswith(prefix):
+            yield item.term[plen:]
+            item = termlist.next()
+
+    def match_terms(self, query_string, name, limit=0, offset=0, sort=None):
+        """Collect prefixed terms over documents matching search terms.
+
+        Returns the set of 'name' terms ('tag', 'sid', ...) of the
+        matching documents, with the prefix removed.  Terms are read
+        from the documents' term lists, without loading the documents.
+        'limit', 'offset' and 'sort' select the matches as for
+        search().
+
+        """
+        if name == 'sid' and not self._has_sid_index():
+            def terms(docid):
+                for source in self._docid_terms(docid, self._find_prefix('source')):
+                    prefix = self._make_source_prefix(source)
+                    for oid in self._docid_terms(docid, prefix):
+                        yield '%s:%s' % (source, oid)
+        else:
+            prefix = self._find_prefix(name) or name
+            terms = lambda docid: self._docid_terms(docid, prefix)
+
+        values = set()
+        remaining = limit
+        for matches in self.iter_matches(query_string, sort=sort, offset=offset,
+                                         maxpagesize=10000):
+            if limit:
+                matches = matches[:remaining]
+                remaining -= len(matches)
+            for docid, percent in matches:
+                values.update(terms(docid))
+            if limit and not remaining:
+                break
+        return values
+
+    def count(self, query_string, exact=True):
+        """Count documents matching search terms.
+
+        If 'exact' is False the matcher may stop early, and the
+        returned count is an estimate.
+
+        """
+        count = self._term_count(query_string)
+        if count is not None:
+            return count
+        key = None
+        if exact and self._cacheable(query_string):
+            key = self._cache_key(query_string)
+            count, matches = self._cached_results(key)
+            if count is not None:
+                return count
+        enquire = self._enquire(query_string)
+        if exact:
+            check = self.xapian.get_doccount()
+        else:
+            check = 0
+        with timer('xapian.get_mset'):
+            mset = enquire.get_mset(0, 0, check)
+        count = mset.get_matches_estimated()
+        if key:
+            # keep any matches already cached for the query
+            self.query_cache.put_results(key, count, matches)
+        return count
+
+    def count_bounds(self, query_string):
+        """Bounds on the number of documents matching search terms.
+
+        Returns a (lower, estimated, upper) tuple, without requiring
+        the matcher to visit every matching document.
+
+        """
+        count = self._term_count(query_string)
+        if count is not None:
+            return (count, count, count)
+        enquire = self._enquire(query_string)
+        with timer('xapian.get_mset'):
+            mset = enquire.get_mset(0, 0)
+        return (mset.get_matches_lower_bound(),
+                mset.get_matches_estimated(),
+                mset.get_matches_upper_bound())
+
+    def facets(self, query_string, names=['tag', 'source', 'year']):
+        """Count facet values over documents matching search terms.
+
+        Supported facets are 'tag', 'source' and 'year'.  Returns a
+        dict mapping each requested facet name to a list of (value,
+        count) tuples, most frequent first.
+
+        Tag and source facets are counted from value slots, which
+        databases created before they existed only have for every
+        document after a full restore.  Until then they are counted
+        from the term lists of the matching documents, which is
+        slower.
+
+        """
+        for name in names:
+            if name not in self.FACET_SLOT:
+                raise DatabaseError("Unknown facet '%s'." % name)
+
+        termfacets = []
+        if not self._has_facet_values():
+            termfacets = [name for name in names if name in self.TERM_FACETS]
+
+        facets = {}
+        if termfacets:
+            facets.update(self._term_facets(query_string, termfacets))
+
+        enquire = self._enquire(query_string)
+        spies = {}
+        for name in names:
+            if name in termfacets:
+                continue
+            spy = xapian.ValueCountMatchSpy(self.FACET_SLOT[name])
+            enquire.add_matchspy(spy)
+            spies[name] = spy
+
+        # the spies see every document the matcher checks
+        if spies:
+            with timer('xapian.get_mset'):
+                enquire.get_mset(0, 0, self.xapian.get_doccount())
+
+        for name, spy in spies.iteritems():
+            counts = {}
+            for item in spy.values():
+                if name == 'year':
+                    values = [str(int(xapian.sortable_unserialise(item.term)))]
+                else:
+                    # multiple values are stored newline separated
+                    values = item.term.split('\n')
+                for value in values:
+                    counts[value] = counts.get(value, 0) + item.termfreq
+            facets[name] = sorted(counts.items(), key=lambda c: (-c[1], c[0]))
+        return facets
+
+    # count facets from the prefixed terms of the matching documents
+    def _term_facets(self, query_string, names):
+        counts = dict([(name, {}) for name in names])
+        for matches in self.iter_matches(query_string, maxpagesize=10000):
+            for docid, percent in matches:
+                for name in names:
+                    ncounts = counts[name]
+                    for value in self._docid_terms(docid, self._find_prefix(name)):
+                        ncounts[value] = ncounts.get(value, 0) + 1
+        return dict([(name, sorted(ncounts.items(), key=lambda c: (-c[1], c[0])))
+                     for name, ncounts in counts.iteritems()])
 
     def _doc_for_term(self, term):
         enquire = xapian.Enquire(self.xapian)
         query = xapian.Query(term)
         enquire.set_query(query)
-        mset = enquire.get_mset(0, 2)
+        with timer('xapian.get_mset'):
+            mset = enquire.get_mset(0, 2)
         # FIXME: need to throw an exception if more than one match found
         if mset:
             return Document(self, mset[0].document)
@@ -310,6 +842,7 @@ class Database():
 
     ########################################
 
+    @timed('xapian.replace_document')
     def replace_document(self, docid, doc):
         """Replace (sync) document to database."""
         self.xapian.replace_document(docid, doc)
@@ -318,13 +851,69 @@ class Database():
         """Delete document from database."""
         self.xapian.delete_document(docid)
 
+    def begin_transaction(self):
+        """Begin a transaction.
+
+        Changes made until the transaction is committed are written to
+        the database together.
+
+        """
+        self.xapian.begin_transaction()
+
+    @timed('xapian.commit')
+    def commit_transaction(self):
+        """Commit the current transaction."""
+        self.xapian.commit_transaction()
+
+    def cancel_transaction(self):
+        """Discard all changes made in the current transaction."""
+        self.xapian.cancel_transaction()
+
+    @contextlib.contextmanager
+    def batch(self, size=1000):
+        """Context manager grouping index changes in transactions.
+
+        Yields a function to be called after each document is synced,
+        which commits the transaction every 'size' calls ('size' of 0
+        or None commits only at the end).  The last transaction is
+        committed when the block exits.
+
+        If the block raises (or is interrupted), the documents synced
+        so far are still committed, since their docdirs have already
+        been written and each document is replaced in the index
+        whole.  The original exception is then re-raised.  If that
+        commit fails as well, the transaction is cancelled and the
+        original exception is still the one raised.
+
+        """
+        synced = [0]
+        def checkpoint():
+            synced[0] += 1
+            if size and synced[0] % size == 0:
+                self.commit_transaction()
+                self.begin_transaction()
+
+        self.begin_transaction()
+        try:
+            yield checkpoint
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.commit_transaction()
+            except Exception:
+                try:
+                    self.cancel_transaction()
+                except Exception:
+                    pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.commit_transaction()
+
     ########################################
 
-    def restore(self, log=False):
-        """Restore a database from an existing root."""
-        docdirs = os.listdir(self.root)
-        docdirs.sort()
-        for ddir in docdirs:
+    # return (docid, docdir, docfiles) for the document directories in
+    # the root, in docid order
+    def _docdirs(self):
+        for ddir in sorted(os.listdir(self.root)):
             if ddir == '.xapers':
                 continue
             docdir = os.path.join(self.root, ddir)
@@ -332,9 +921,6 @@ class Database():
                 # skip things that aren't directories
                 continue
 
-            if log:
-                print >>sys.stderr, docdir
-
             # if we can't convert the directory name into an integer,
             # assume it's not relevant to us and continue
             try:
@@ -347,28 +933,107 @@ class Database():
                 # skip empty directories
                 continue
 
-            if log:
-                print >>sys.stderr, '  docid:', docid
+            yield docid, docdir, docfiles
 
-            try:
-                doc = self[docid]
-            except xapian.DocNotFoundError:
-                doc = Document(self, docid=docid)
+    # return the ids of all documents in the database
+    def _docids(self):
+        for post in self.xapian.postlist(''):
+            yield post.docid
+
+    # true if docdir differs from when its document was last synced
+    def _docdir_changed(self, docid, docdir):
+        try:
+            xapian_doc = self.xapian.get_document(docid)
+        except xapian.DocNotFoundError:
+            return True
+        fingerprint = xapian_doc.get_value(self._find_slot('fingerprint'))
+        return fingerprint != docdir_fingerprint(docdir)
+
+    def restore(self, log=False, jobs=1, batch=1000, incremental=False):
+        """Restore a database from an existing root.
+
+        Text is extracted from document files by up to 'jobs' parallel
+        parsers, while documents are indexed in docid order.  Index
+        changes are committed every 'batch' documents.
+
+        If 'incremental' is True, only new document directories and
+        those that changed since their document was last synced are
+        indexed, changed documents are reindexed from scratch, and
+        documents whose directories have been removed are deleted.
+
+        """
+        docdirs = list(self._docdirs())
+
+        removed = []
+        if incremental:
+            found = set([docid for docid, docdir, docfiles in docdirs])
+            removed = [docid for docid in self._docids() if docid not in found]
+            ndocdirs = len(docdirs)
+            docdirs = [(docid, docdir, docfiles)
+                       for docid, docdir, docfiles in docdirs
+                       if self._docdir_changed(docid, docdir)]
+            if log:
+                print >>sys.stderr, "%d new or changed, %d removed, %d unchanged." % (
+                    len(docdirs), len(removed), ndocdirs - len(docdirs))
 
+        paths = []
+        for docid, docdir, docfiles in docdirs:
             for dfile in docfiles:
-                dpath = os.path.join(docdir, dfile)
-                if dfile == 'bibtex':
-                    if log:
-                        print >>sys.stderr, '  adding bibtex'
-                    doc.add_bibtex(dpath)
-                elif os.path.splitext(dpath)[1] == '.pdf':
-                    if log:
-                        print >>sys.stderr, '  adding file:', dfile
-                    doc.add_file(dpath)
-                elif dfile == 'tags':
-                    if log:
-                        print >>sys.stderr, '  adding tags'
-                    with open(dpath, 'r') as f:
-                        tags = f.read().strip().split('\n')
-                    doc.add_tags(tags)
-            doc.sync()
+                if os.path.splitext(dfile)[1] == '.pdf':
+                    paths.append(os.path.join(docdir, dfile))
+        texts = parse_files(paths, jobs)
+
+        with self.batch(batch) as checkpoint:
+            for docid in removed:
+                if log:
+                    print >>sys.stderr, 'removing docid:', docid
+                self.delete_document(docid)
+
+            for docid, docdir, docfiles in docdirs:
+                if log:
+                    print >>sys.stderr, docdir
+                    print >>sys.stderr, '  docid:', docid
+
+                if incremental and docid in self:
+                    # reindex changed documents from scratch
+                    self.delete_document(docid)
+
+                try:
+                    doc = self[docid]
+                except xapian.DocNotFoundError:
+                    doc = Document(self, docid=docid)
+
+                # backfill times from the docdir, before its files
+                # are rewritten on sync
+                doc.set_times(*docdir_times(docdir))
+
+                for dfile in docfiles:
+                    dpath = os.path.join(docdir, dfile)
+                    if dfile == 'bibtex':
+                        if log:
+                            print >>sys.stderr, '  adding bibtex'
+                        doc.add_bibtex(dpath)
+                    elif os.path.splitext(dpath)[1] == '.pdf':
+                        if log:
+                            print >>sys.stderr, '  adding file:', dfile
+                        path, text = texts.next()
+                        if isinstance(text, ParseError):
+                            # index the file without its text
+                            print >>sys.stderr, "Warning: %s: %s" % (dpath, text)
+                            text = ''
+                        doc.add_file(dpath, text=text)
+                    elif dfile == 'tags':
+                        if log:
+                            print >>sys.stderr, '  adding tags'
+                        with open(dpath, 'r') as f:
+                            tags = f.read().strip().split('\n')
+                        doc.add_tags(tags)
+                doc.sync()
+                checkpoint()
+
+        # a full restore re-adds every sid, completing the sid index
+        if not incremental:
+            self.xapian.set_metadata(self.SID_INDEX_KEY, '1')
+            # and sets the facet values of every document
+            self.xapian.set_metadata(self.FACET_VALUES_KEY, '1')
+            self.xapian.commit()
@@ -19,12 +19,42 @@ Jameson Rollins <jrollins@finestructure.net>
 """
 
 import os
+import json
+import time
 import shutil
+import hashlib
 import xapian
 
-from parser import parse_data
+from parser import parse_data, parse_file
+from files import copy_file, write_file
 from source import Sources
-from bibtex import Bibtex
+from instrument import timer, timed
+
+##################################################
+
+def docdir_fingerprint(docdir):
+    """Return a fingerprint of the contents of a document directory.
+
+    The fingerprint covers the names, sizes and modification times of
+    all files in the directory.
+
+    """
+    sha = hashlib.sha1()
+    for name in sorted(os.listdir(docdir)):
+        st = os.stat(os.path.join(docdir, name))
+        sha.update('%s\0%d\0%r\n' % (name, st.st_size, st.st_mtime))
+    return sha.hexdigest()
+
+def docdir_times(docdir):
+    """Return the (earliest, latest) modification times of the files
+    in a document directory, or (None, None) if it is empty.
+
+    """
+    mtimes = [os.stat(os.path.join(docdir, name)).st_mtime
+              for name in os.listdir(docdir)]
+    if not mtimes:
+        return None, None
+    return min(mtimes), max(mtimes)
 
 ##################################################
 
@@ -38,16 +68,86 @@ class DocumentError(Exception):
 ##################################################
 
 class Documents():
-    """Represents a set of Xapers documents given a Xapian mset."""
+    """Represents a set of Xapers documents given a Xapian enquire.
+
+    Matches are retrieved from the enquire in windows of 'pagesize'
+    documents, starting 'offset' matches into the result set.  Only
+    the current window is held, and the next window is only fetched
+    when iteration moves past the end of the current one.  If 'limit'
+    is non-zero at most 'limit' documents are returned.
+
+    'matches' may provide the first (docid, percent) matches in
+    order, e.g. from the query cache, in which case the enquire is
+    only used for results beyond them.  If 'enquire' is None the
+    matches are the full list.
 
-    def __init__(self, db, mset):
+    """
+
+    PAGESIZE = 100
+
+    def __init__(self, db, enquire, offset=0, limit=0, pagesize=None, total=None,
+                 matches=None):
         self.db = db
-        self.mset = mset
+        self.enquire = enquire
+        self.matches = matches
+        self.offset = offset
+        self.limit = limit
+        self.pagesize = pagesize or self.PAGESIZE
+        self.mset = None
+        self.mstart = None
         self.index = -1
-        self.max = len(mset)
+        self.max = None
+        # total number of matches, if known in advance
+        self.total = total
+
+    # return the mset window holding the result at index.  if
+    # 'check' is non-zero, the matcher is made to check at least
+    # that many documents, so that the match counts are exact.
+    def _window(self, index, check=0):
+        start = index - (index % self.pagesize)
+        if self.mset is None or start != self.mstart or check:
+            size = self.pagesize
+            if self.limit:
+                size = min(size, self.limit - start)
+            with timer('xapian.get_mset'):
+                self.mset = self.enquire.get_mset(self.offset + start, size, check)
+            self.mstart = start
+        return self.mset
+
+    # return the exact number of matches, reusing the current window
+    # if its counts are already exact
+    def _matches(self):
+        if self.total is None and self.enquire is None:
+            self.total = len(self.matches)
+        if self.total is None:
+            mset = self.mset
+            if mset is None \
+               or mset.get_matches_lower_bound() != mset.get_matches_upper_bound():
+                doccount = self.db.xapian.get_doccount()
+                if self.mstart in [None, 0]:
+                    mset = self._window(0, doccount)
+                else:
+                    with timer('xapian.get_mset'):
+                        mset = self.enquire.get_mset(0, 0, doccount)
+            self.total = mset.get_matches_estimated()
+        return self.total
 
     def __getitem__(self, index):
-        m = self.mset[index]
+        if index < 0:
+            raise IndexError
+        if self.limit and index >= self.limit:
+            raise IndexError
+        if self.matches is not None and self.offset + index < len(self.matches):
+            docid, percent = self.matches[self.offset + index]
+            doc = Document(self.db, self.db.xapian.get_document(docid))
+            doc.matchp = percent
+            return doc
+        if self.enquire is None:
+            raise IndexError
+        mset = self._window(index)
+        if index - self.mstart >= len(mset):
+            raise IndexError
+        m = mset[index - self.mstart]
         doc = Document(self.db, m.document)
         doc.matchp = m.percent
         return doc
@@ -56,13 +156,18 @@ class Documents():
         return self
 
     def __len__(self):
+        if self.max is None:
+            self.max = max(0, self._matches() - self.offset)
+            if self.limit:
+                self.max = min(self.max, self.limit)
         return self.max
 
     def next(self):
         self.index = self.index + 1
-        if self.index == self.max:
+        try:
+            return self[self.index]
+        except IndexError:
             raise StopIteration
-        return self[self.index]
 
 ##################################################
 
@@ -73,6 +178,11 @@ class Document():
         # Xapers db
         self.db = db
 
+        # parts of the document changed since it was loaded, that need
+        # to be written on sync: 'index' for the xapian document, and
+        # 'tags', 'bib' and 'files' for the docdir
+        self._dirty = set()
+
         # if Xapian doc provided, initiate for that document
         if xapian_doc:
             self.xapian_doc = xapian_doc
@@ -90,12 +200,19 @@ class Document():
             else:
                 self.docid = self.db._generate_docid()
             self._add_term(self.db._find_prefix('id'), self.docid)
+            self._dirty.update(['index', 'tags', 'bib', 'files'])
 
         # specify a directory in the Xapers root for document data
         self.docdir = os.path.join(self.db.root, '%010d' % self.docid)
 
         self.bibentry = None
 
+        # display fields from the summary value
+        self._summary = None
+
+        # added and modified times to use on the next sync, if not now
+        self._times = (None, None)
+
         self._infiles = {}
 
     def get_docid(self):
@@ -110,10 +227,12 @@ class Document():
             os.makedirs(self.docdir)
 
     def _write_files(self):
-        for name, data in self._infiles.iteritems():
+        for name, infile in self._infiles.iteritems():
             path = os.path.join(self.docdir, name)
-            with open(path, 'w') as f:
-                f.write(data)
+            if 'path' in infile:
+                copy_file(infile['path'], path, link=infile['link'])
+            else:
+                write_file(path, infile['data'])
 
     def _write_bibfile(self):
         bibpath = self.get_bibpath()
@@ -138,19 +257,49 @@ class Document():
         if os.path.exists(self.docdir) and os.path.isdir(self.docdir):
             shutil.rmtree(self.docdir)
 
+    @timed('document.sync')
     def sync(self):
-        """Sync document to database."""
-        # FIXME: add value for modification time
+        """Sync document to database.
+
+        Only the parts of the document that have changed are written,
+        so syncing an unchanged document does nothing.  If the sync
+        fails, the docdir is removed only if this sync created it.
+
+        """
+        dirty = self._dirty
+        if not dirty:
+            return
+        # an existing docdir holds the document's files, bibtex and
+        # tags, which must survive a failed sync
+        created = not os.path.exists(self.docdir)
         # FIXME: catch db not writable errors
         try:
             self._make_docdir()
-            self._write_files()
-            self._write_bibfile()
-            self._write_tagfile()
+            if 'files' in dirty:
+                self._write_files()
+            # the bibtex file field refers to the files
+            if 'bib' in dirty or 'files' in dirty:
+                self._write_bibfile()
+            if 'tags' in dirty:
+                self._write_tagfile()
+            # backfill the summary of documents indexed before it was
+            # stored as a value
+            if not self.xapian_doc.get_value(self.db._find_slot('summary')):
+                self._load_bib()
+                self._set_summary(self.bibentry)
+            self._set_facets()
+            self._set_sort_values()
+            fslot = self.db._find_slot('fingerprint')
+            if dirty & set(['tags', 'bib', 'files']) \
+               or not self.xapian_doc.get_value(fslot):
+                self.xapian_doc.add_value(fslot, docdir_fingerprint(self.docdir))
             self.db.replace_document(self.docid, self.xapian_doc)
         except:
-            self._rm_docdir()
+            if created:
+                self._rm_docdir()
             raise
+        self._infiles = {}
+        self._dirty = set()
 
     def purge(self):
         """Purge document from database and root."""
@@ -165,18 +314,33 @@ class Document():
     ########################################
     # internal stuff
 
-    # add an individual prefix'd term for the document
+    # true if the document has term
+    def _has_term(self, term):
+        try:
+            return self.xapian_doc.termlist().skip_to(term).term == term
+        except StopIteration:
+            return False
+
+    # add an individual prefix'd term for the document, returning
+    # True if the term was not already present
     def _add_term(self, prefix, value):
         term = '%s%s' % (prefix, value)
+        if self._has_term(term):
+            return False
         self.xapian_doc.add_term(term)
+        self._dirty.add('index')
+        return True
 
-    # remove an individual prefix'd term for the document
+    # remove an individual prefix'd term for the document, returning
+    # True if the term was present
     def _remove_term(self, prefix, value):
         term = '%s%s' % (prefix, value)
         try:
             self.xapian_doc.remove_term(term)
         except xapian.InvalidArgumentError:
-            pass
+            return False
+        self._dirty.add('index')
+        return True
 
     # Parse 'text' and add a term to 'message' for each parsed
     # word. Each term will be added both prefixed (if prefix is not
@@ -190,6 +354,7 @@ class Document():
         if prefix:
             term_gen.index_text(text, 1, prefix)
         term_gen.index_text(text)
+        self._dirty.add('index')
             
     # return a list of terms for prefix
     def _term_iter(self, prefix=None):
@@ -233,18 +398,51 @@ class Document():
     ########################################
     # files
 
-    def add_file_data(self, name, data):
+    def add_file_data(self, name, data, text=None):
         """Add a file data to document.
 
-        'name' is the name of the file, 'data is the file data.
+        'name' is the name of the file, 'data is the file data.  If
+        the text of the file has already been extracted it can be
+        provided as 'text'.
 
         File will not copied in to docdir until sync().
         """
         # FIXME: set mime type term
 
         # parse the file data into text
-        text = parse_data(data)
+        if text is None:
+            text = parse_data(data)
+
+        self._index_file(name, text)
+
+        # add it to the cache to be written at sync()
+        self._infiles[name] = {'data': data}
+        self._dirty.add('files')
 
+    def add_file(self, infile, text=None, name=None, link=False):
+        """Add a file to document.
+
+        Added file will have the same name, unless 'name' is given.
+        If the text of the file has already been extracted it can be
+        provided as 'text', otherwise it is extracted directly from
+        infile.  The file is never read in to memory.
+
+        File will not copied in to docdir until sync().  If 'link' is
+        True it will be hard linked rather than copied where possible,
+        in which case later changes to infile also change the stored
+        file.
+        """
+        if text is None:
+            text = parse_file(infile)
+        if name is None:
+            name = os.path.basename(infile)
+
+        self._index_file(name, text)
+
+        self._infiles[name] = {'path': infile, 'link': link}
+        self._dirty.add('files')
+
+    def _index_file(self, name, text):
         # generate terms from the text
         self._gen_terms(None, text)
 
@@ -257,21 +455,6 @@ class Document():
         prefix = self.db._find_prefix('file')
         self._add_term(prefix, name)
 
-        # add it to the cache to be written at sync()
-        self._infiles[name] = data
-
-    def add_file(self, infile):
-        """Add a file to document.
-
-        Added file will have the same name.
-
-        File will not copied in to docdir until sync().
-        """
-        with open(infile, 'r') as f:
-            data = f.read()
-        name = os.path.basename(infile)
-        self.add_file_data(name, data)
-
     def get_files(self):
         """Return files associated with document."""
         return list(self.term_iter('file'))
@@ -293,8 +476,10 @@ class Document():
     def _purge_sources_prefix(self, source):
         # purge all terms for a given source prefix
         prefix = self.db._make_source_prefix(source)
-        for i in self._term_iter(prefix):
+        sprefix = self.db._find_prefix('sid')
+        for i in list(self._term_iter(prefix)):
             self._remove_term(prefix, i)
+            self._remove_term(sprefix, '%s:%s' % (source, i))
         self._remove_term(self.db._find_prefix('source'), source)
 
     def add_sid(self, sid):
@@ -307,6 +492,8 @@ class Document():
         self._add_term(self.db._find_prefix('source'), source)
         # add a term for the sid, with source as prefix
         self._add_term(self.db._make_source_prefix(source), oid)
+        # and one in the database wide sid index
+        self._add_term(self.db._find_prefix('sid'), '%s:%s' % (source, oid))
 
     def get_sids(self):
         """Return a list of sids for document."""
@@ -321,7 +508,8 @@ class Document():
         """Add tags from list to document."""
         prefix = self.db._find_prefix('tag')
         for tag in tags:
-            self._add_term(prefix, tag)
+            if self._add_term(prefix, tag):
+                self._dirty.add('tags')
 
     def get_tags(self):
         """Return a list of tags associated with document."""
@@ -331,7 +519,8 @@ class Document():
         """Remove tags from a document."""
         prefix = self.db._find_prefix('tag')
         for tag in tags:
-            self._remove_term(prefix, tag)
+            if self._remove_term(prefix, tag):
+                self._dirty.add('tags')
 
     # TITLE
     def _set_title(self, title):
@@ -366,6 +555,7 @@ class Document():
         self._add_term(prefix, year)
         facet = self.db._find_facet('year')
         self.xapian_doc.add_value(facet, xapian.sortable_serialise(year))
+        self._dirty.add('index')
 
     ########################################
     # bibtex
@@ -400,13 +590,17 @@ class Document():
 
         self._set_bibkey(bibentry.key)
 
+        self._set_summary(bibentry)
+
     def add_bibentry(self, bibentry):
         """Add bibentry object."""
         self.bibentry = bibentry
         self._index_bibentry(self.bibentry)
+        self._dirty.add('bib')
 
     def add_bibtex(self, bibtex):
         """Add bibtex to document, as string or file path."""
+        from bibtex import Bibtex
         self.add_bibentry(Bibtex(bibtex)[0])
 
     def _load_bib(self):
@@ -414,6 +608,7 @@ class Document():
             return
         bibpath = self.get_bibpath()
         if os.path.exists(bibpath):
+            from bibtex import Bibtex
             self.bibentry = Bibtex(bibpath)[0]
 
     def get_bibtex(self):
@@ -436,31 +631,120 @@ class Document():
         self._load_bib()
         self._index_bibentry(self.bibentry)
 
+    ########################################
+    # facets
+
+    # store multi-valued facets as newline separated values
+    def _set_facets(self):
+        self.xapian_doc.add_value(self.db._find_slot('tags'),
+                                  '\n'.join(self.get_tags()))
+        self.xapian_doc.add_value(self.db._find_slot('sources'),
+                                  '\n'.join(self.term_iter('source')))
+
+    ########################################
+    # sort values
+
+    def set_times(self, added=None, modified=None):
+        """Set the added and modified times of the document.
+
+        Times are unix times, and are used by the next sync in place of
+        the current time.  An existing added time is never replaced.
+
+        """
+        self._times = (added, modified)
+        self._dirty.add('index')
+
+    # set the values results can be sorted on, from the summary.  the
+    # added time is only set the first time a document is synced.
+    def _set_sort_values(self):
+        summary = self._get_summary()
+        title = summary.get('title', '').lower()
+        self.xapian_doc.add_value(self.db._find_slot('title'),
+                                  title.encode('utf-8'))
+        author = ''
+        if summary.get('authors'):
+            author = summary['authors'][0].lower()
+        self.xapian_doc.add_value(self.db._find_slot('author'),
+                                  author.encode('utf-8'))
+        now = time.time()
+        added, modified = self._times
+        self._times = (None, None)
+        if not self.xapian_doc.get_value(self.db._find_slot('added')):
+            self.xapian_doc.add_value(self.db._find_slot('added'),
+                                      xapian.sortable_serialise(added or now))
+        self.xapian_doc.add_value(self.db._find_slot('modified'),
+                                  xapian.sortable_serialise(modified or now))
+
+    ########################################
+    # summary
+
+    # fields that identify the journal, in order of preference
+    JOURNAL_FIELDS = [
+        ('journal', None),
+        ('container-title', None),
+        ('arxiv', 'arXiv.org'),
+        ('dcc', 'LIGO DCC'),
+        ]
+
+    def _make_summary(self, bibentry):
+        summary = {}
+        if not bibentry:
+            return summary
+        fields = bibentry.get_fields()
+        summary['key'] = bibentry.key
+        authors = bibentry.get_authors()
+        if authors:
+            summary['authors'] = authors
+        for field in ['title', 'year']:
+            if field in fields:
+                summary[field] = fields[field]
+        for field, name in self.JOURNAL_FIELDS:
+            if field in fields:
+                summary['journal'] = name or fields[field]
+                break
+        urls = [fields[field] for field in ['url', 'adsurl'] if field in fields]
+        if urls:
+            summary['urls'] = urls
+        return summary
+
+    def _set_summary(self, bibentry):
+        self._summary = self._make_summary(bibentry)
+        value = json.dumps(self._summary, separators=(',', ':'))
+        self.xapian_doc.add_value(self.db._find_slot('summary'), value)
+        self._dirty.add('index')
+
+    def _get_summary(self):
+        if self._summary is None:
+            value = self.xapian_doc.get_value(self.db._find_slot('summary'))
+            if value:
+                self._summary = json.loads(value)
+            else:
+                # documents indexed before the summary value existed
+                self._load_bib()
+                self._summary = self._make_summary(self.bibentry)
+        return self._summary
+
     ########################################
 
     def get_key(self):
-        self._load_bib()
-        if not self.bibentry:
-            return
-        return self.bibentry.key
+        """Get the bibtex key of document."""
+        return self._get_summary().get('key')
 
     def get_title(self):
         """Get the title from document bibtex."""
-        self._load_bib()
-        if not self.bibentry:
-            return
-        fields = self.bibentry.get_fields()
-        if 'title' in fields:
-            return fields['title']
+        return self._get_summary().get('title')
+
+    def get_authors(self):
+        """Get the list of authors from document bibtex."""
+        return self._get_summary().get('authors', [])
 
     def get_year(self):
-        """Get the title from document bibtex."""
-        self._load_bib()
-        if not self.bibentry:
-            return
-        fields = self.bibentry.get_fields()
-        if 'year' in fields:
-            return fields['year']
+        """Get the year from document bibtex."""
+        return self._get_summary().get('year')
+
+    def get_journal(self):
+        """Get the journal name from document bibtex."""
+        return self._get_summary().get('journal')
 
     def get_urls(self):
         """Get all URLs associated with document."""
@@ -470,11 +754,5 @@ class Document():
         for sid in self.get_sids():
             urls.append(sources[sid].url)
         # get urls from bibtex
-        self._load_bib()
-        if self.bibentry:
-            fields = self.bibentry.get_fields()
-            if 'url' in fields:
-                urls.append(fields['url'])
-            if 'adsurl' in fields:
-                urls.append(fields['adsurl'])
+        urls += self._get_summary().get('urls', [])
         return urls
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import hashlib
+import shutil
+import urllib2
+import tempfile
+import threading
+
+from cache import FileCache
+from instrument import timer
+
+##################################################
+
+# responses younger than this, in seconds, are served from the cache
+# without revalidation
+DEFAULT_TTL = 24 * 3600
+
+class FetchError(IOError):
+    pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def _get_cache():
+    # the response cache is shared by all document stores, and
+    # bounded to XAPERS_FETCH_CACHE_SIZE MB (0 disables)
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = int(os.getenv('XAPERS_FETCH_CACHE_SIZE', 256))
+            path = os.path.expanduser(os.path.join('~','.xapers','cache','http'))
+            _cache = size > 0 and FileCache(path, size * 1024 * 1024) or False
+        return _cache
+
+def offline():
+    """True if network access is disabled by XAPERS_OFFLINE."""
+    return bool(os.getenv('XAPERS_OFFLINE'))
+
+# cache entries are a json header line, holding the time the response
+# was fetched or last revalidated and its validators, followed by the
+# response body
+def _load(cache, key):
+    data = cache.get(key)
+    if data is None:
+        return None, None
+    try:
+        header, body = data.split('\n', 1)
+        return json.loads(header), body
+    except ValueError:
+        return None, None
+
+def _store(cache, key, meta, body):
+    cache.put(key, json.dumps(meta) + '\n' + body)
+
+def _key(url, headers):
+    accept = ['%s: %s' % (k.lower(), v) for k, v in sorted(headers.items())
+              if k.lower().startswith('accept')]
+    return hashlib.sha1('\n'.join([url] + accept)).hexdigest()
+
+def fetch(url, headers={}, ttl=DEFAULT_TTL, cache=True):
+    """Retrieve url, returning the response body as a byte string.
+
+    Responses are kept in a persistent cache, keyed by URL and Accept
+    headers.  Cached responses younger than 'ttl' seconds are returned
+    directly.  Older ones are revalidated with their ETag or
+    Last-Modified validators, so unchanged responses are not
+    downloaded again.  In offline mode only cached responses are
+    returned, however old.  Pass cache=False for large downloads,
+    such as document files, that should not be cached.
+
+    """
+    rcache = cache and _get_cache()
+    key = None
+    meta = body = None
+    if rcache:
+        key = _key(url, headers)
+        meta, body = _load(rcache, key)
+        if meta and (offline() or time.time() - meta['fetched'] < ttl):
+            return body
+
+    if offline():
+        raise FetchError("%s not available offline." % url)
+
+    req = urllib2.Request(url)
+    for name, value in headers.items():
+        req.add_header(name, value)
+    if meta:
+        if meta.get('etag'):
+            req.add_header('If-None-Match', meta['etag'])
+        if meta.get('last_modified'):
+            req.add_header('If-Modified-Since', meta['last_modified'])
+
+    try:
+        with timer('fetch.http'):
+            f = urllib2.urlopen(req)
+            try:
+                body = f.read()
+                info = f.info()
+            finally:
+                f.close()
+    except urllib2.HTTPError as e:
+        if e.code == 304 and meta:
+            meta['fetched'] = time.time()
+            _store(rcache, key, meta, body)
+            return body
+        raise
+
+    if rcache:
+        meta = {
+            'fetched': time.time(),
+            'etag': info.getheader('ETag'),
+            'last_modified': info.getheader('Last-Modified'),
+            }
+        _store(rcache, key, meta, body)
+    return body
+
+def cached(url, retrieve, ttl=DEFAULT_TTL):
+    """Return the result of retrieve(), cached under url.
+
+    For sources that can not use fetch(), e.g. because they need
+    special authentication.  Entries can not be revalidated, so are
+    retrieved again once older than 'ttl' seconds, except in offline
+    mode.
+
+    """
+    rcache = _get_cache()
+    if rcache:
+        key = _key(url, {})
+        meta, body = _load(rcache, key)
+        if meta and (offline() or time.time() - meta['fetched'] < ttl):
+            return body
+    if offline():
+        raise FetchError("%s not available offline." % url)
+    with timer('fetch.retrieve'):
+        body = retrieve()
+    if rcache:
+        _store(rcache, key, {'fetched': time.time()}, body)
+    return body
+
+def fetch_to_file(url, headers={}, suffix=''):
+    """Retrieve url into a temporary file, returning the open file.
+
+    The response is streamed to disk in chunks rather than read into
+    memory, for large downloads such as document files.  The file is
+    positioned at the start, and is removed when closed.  Responses
+    are not cached.
+
+    """
+    if offline():
+        raise FetchError("%s not available offline." % url)
+    req = urllib2.Request(url)
+    for name, value in headers.items():
+        req.add_header(name, value)
+    with timer('fetch.file'):
+        f = urllib2.urlopen(req)
+        tmp = tempfile.NamedTemporaryFile(prefix='xapers-', suffix=suffix)
+        try:
+            shutil.copyfileobj(f, tmp, 1 << 20)
+            tmp.flush()
+            tmp.seek(0)
+        except:
+            tmp.close()
+            raise
+        finally:
+            f.close()
+    return tmp
@@ -0,0 +1,70 @@
+import os
+import fcntl
+import shutil
+import tempfile
+
+from instrument import timed
+##################################################
+
+# linux ioctl to share the data blocks of one file with another, on
+# filesystems that support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+CHUNKSIZE = 1 << 20
+
+def _tempfile(dest):
+    # temporary file next to dest, to be renamed into place
+    return tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp')
+
+@timed('file.write')
+def write_file(dest, data):
+    """Atomically write data to dest."""
+    fd, tmppath = _tempfile(dest)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmppath, dest)
+    except:
+        os.remove(tmppath)
+        raise
+
+@timed('file.copy')
+def copy_file(src, dest, link=False):
+    """Atomically place a copy of file src at dest.
+
+    If 'link' is True dest is made a hard link to src where possible.
+    Otherwise the file data is cloned if the filesystem supports it,
+    or else copied in chunks, so large files are never held in
+    memory.  Nothing is done if src and dest are already the same
+    file.
+
+    """
+    if os.path.exists(dest) and os.path.samefile(src, dest):
+        return
+    fd, tmppath = _tempfile(dest)
+    try:
+        if link:
+            os.close(fd)
+            fd = None
+            os.remove(tmppath)
+            try:
+                os.link(src, tmppath)
+            except OSError:
+                # e.g. src is on a different filesystem
+                fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        if fd is not None:
+            with os.fdopen(fd, 'wb') as fout:
+                with open(src, 'rb') as fin:
+                    try:
+                        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+                    except (IOError, OSError):
+                        shutil.copyfileobj(fin, fout, CHUNKSIZE)
+            # match the permissions a plain write would have given
+            mask = os.umask(0)
+            os.umask(mask)
+            os.chmod(tmppath, 0666 & ~mask)
+        os.rename(tmppath, dest)
+    except:
+        if os.path.exists(tmppath):
+            os.remove(tmppath)
+        raise
@@ -0,0 +1,165 @@
+import os
+import sys
+import time
+import threading
+import functools
+
+##################################################
+
+# timing of expensive operations is enabled by XAPERS_PROFILE, and
+# costs nothing otherwise
+ENABLED = bool(os.getenv('XAPERS_PROFILE'))
+
+_lock = threading.Lock()
+# name: [calls, total seconds, max seconds]
+_timers = {}
+# name: count
+_counters = {}
+
+_start = None
+_profiler = None
+
+def _add(name, elapsed):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, elapsed, elapsed]
+        else:
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] = max(timer[2], elapsed)
+
+class _Timer(object):
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.name, time.time() - self.start)
+        return False
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+def timer(name):
+    """Context manager timing the enclosed block under name."""
+    if not ENABLED:
+        return _null_timer
+    return _Timer(name)
+
+def timed(name):
+    """Decorator timing every call of a function under name."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+def reset():
+    """Clear all timers and counters."""
+    global _start
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+    _start = time.time()
+
+##################################################
+
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def report(title, stream=None):
+    """Write the timers and counters collected since reset()."""
+    if stream is None:
+        stream = sys.stderr
+    with _lock:
+        timers = sorted(_timers.items(), key=lambda item: item[1][1], reverse=True)
+        counters = sorted(_counters.items())
+    summary = ['total %.3f s' % (time.time() - (_start or time.time()))]
+    rss = _max_rss()
+    if rss is not None:
+        summary.append('max rss %.1f MB' % rss)
+    print >>stream, "xapers profile: %s (%s)" % (title, ', '.join(summary))
+    if timers:
+        width = max([len(name) for name, timer in timers] + [9])
+        print >>stream, "  %-*s %7s %10s %10s %10s" % (
+            width, 'operation', 'calls', 'total (s)', 'mean (ms)', 'max (ms)')
+        for name, (calls, total, longest) in timers:
+            print >>stream, "  %-*s %7d %10.3f %10.2f %10.2f" % (
+                width, name, calls, total, total / calls * 1000, longest * 1000)
+    if counters:
+        width = max([len(name) for name, n in counters] + [9])
+        print >>stream, "  %-*s %7s" % (width, 'counter', 'count')
+        for name, n in counters:
+            print >>stream, "  %-*s %7d" % (width, name, n)
+
+##################################################
+
+def start(title):
+    """Start profiling a command, if enabled.
+
+    The breakdown of timers and counters is written to stderr when
+    the process exits.  If XAPERS_PROFILE_DUMP is set to a file path,
+    the command is also run under cProfile and the stats are dumped
+    to that file (for use with pstats), along with the largest
+    allocation sites in <path>.mem where tracemalloc is available.
+
+    """
+    global _profiler
+    if not ENABLED:
+        return
+    import atexit
+    reset()
+    dump = os.getenv('XAPERS_PROFILE_DUMP')
+    if dump:
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            pass
+        import cProfile
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+    atexit.register(_finish, title, dump)
+
+def _finish(title, dump):
+    if _profiler:
+        _profiler.disable()
+        _profiler.dump_stats(dump)
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        if tracemalloc and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            with open(dump + '.mem', 'w') as f:
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('%s\n' % stat)
+    report(title)
@@ -14,10 +14,11 @@ class Bibview(urwid.WidgetWrap):
         string = ''
 
         with initdb() as db:
-            if db.count(query) == 0:
+            docs = db.search(query, limit=20)
+            if len(docs) == 0:
                 self.ui.set_status('No documents found.')
             else:
-                for doc in db.search(query, limit=20):
+                for doc in docs:
                     bibtex = doc.get_bibtex()
                     if bibtex:
                         string = string + bibtex + '\n'
@@ -1,10 +1,13 @@
 import os
+import Queue
 import urwid
+import xapian
+import threading
 import subprocess
 import collections
 
 from ..cli import initdb
-from ..database import DatabaseLockError
+from ..database import Database, DatabaseLockError
 
 ############################################################
 
@@ -46,27 +49,20 @@ class DocItem(urwid.WidgetWrap):
 
         field_data['tags'] = ' '.join(self.doc.get_tags())
 
-        bibdata = self.doc.get_bibdata()
-        if bibdata:
-            for field, value in bibdata.iteritems():
-                if 'title' == field:
-                    field_data[field] = value
-                elif 'authors' == field:
-                    field_data[field] = ' and '.join(value[:4])
-                    if len(value) > 4:
-                        field_data[field] += ' et al.'
-                elif 'year' == field:
-                    field_data[field] = value
-
-                if field_data['journal'] == '':
-                    if 'journal' == field:
-                        field_data['journal'] = value
-                    elif 'container-title' == field:
-                        field_data['journal'] = value
-                    elif 'arxiv' == field:
-                        field_data['journal'] = 'arXiv.org'
-                    elif 'dcc' == field:
-                        field_data['journal'] = 'LIGO DCC'
+        title = self.doc.get_title()
+        if title:
+            field_data['title'] = title
+        authors = self.doc.get_authors()
+        if authors:
+            field_data['authors'] = ' and '.join(authors[:4])
+            if len(authors) > 4:
+                field_data['authors'] += ' et al.'
+        year = self.doc.get_year()
+        if year:
+            field_data['year'] = year
+        journal = self.doc.get_journal()
+        if journal:
+            field_data['journal'] = journal
 
         urls = self.doc.get_urls()
         if urls:
@@ -122,27 +118,146 @@ class DocItem(urwid.WidgetWrap):
     def keypress(self, size, key):
         return key
 
+class MissingItem(urwid.WidgetWrap):
+    """Row for a matched document no longer in the database."""
+
+    def __init__(self, docid, doc_ind, total_docs):
+        self.doc = None
+        self.docid = docid
+
+        header = urwid.AttrMap(urwid.Columns([
+            ('fixed', 10, urwid.Text('id:%d' % (self.docid))),
+            urwid.Text('(document deleted)'),
+            urwid.Text('(%s/%s)' % (doc_ind, total_docs), align='right'),
+            ]),
+            'head')
+        w = urwid.AttrMap(urwid.Pile([urwid.Divider(' '), header]),
+                          '', {'head': 'head focus'})
+
+        self.__super.__init__(w)
+
+    def selectable(self):
+        return True
+
+    def keypress(self, size, key):
+        return key
+
 ############################################################
 
 class DocWalker(urwid.ListWalker):
-    def __init__(self, docs):
-        self.docs = docs
-        self.ndocs = len(docs)
+    """List walker building result rows on demand.
+
+    Rows are built from a list of (docid, percent) matches, which can
+    be extended while the walker is in use, as results arrive.  The
+    total number of matches shown in each row can be set once known.
+
+    Only the CACHE_SIZE most recently used rows are kept.  If a
+    'schedule' function is given, which should arrange for a callback
+    to be run once the UI is idle, the PREFETCH rows above and below
+    the focus are built in the background, a few at a time, so that
+    they are ready when scrolled to.
+
+    """
+
+    CACHE_SIZE = 200
+    PREFETCH = 20
+    PREFETCH_STEP = 2
+
+    def __init__(self, db, matches=[], total=None, schedule=None):
+        self.db = db
+        self.matches = list(matches)
+        self.total = total
         self.focus = 0
-        self.items = {}
+        # built rows, least recently used first
+        self.items = collections.OrderedDict()
+        self.schedule = schedule
+        self._prefetch_pending = False
+
+    @property
+    def ndocs(self):
+        return len(self.matches)
+
+    def extend(self, matches):
+        """Add matches to the end of the list."""
+        self.matches.extend(matches)
+        self._modified()
+
+    def set_total(self, total):
+        """Set the total number of matches."""
+        self.total = total
+        # rows built so far show an unknown total
+        self.items.clear()
+        self._modified()
+
+    # return the document for docid, or None if it has been deleted.
+    # matches may come from a newer revision of the database than the
+    # one open, in which case it is reopened.
+    def _get_doc(self, docid):
+        try:
+            return self.db[docid]
+        except xapian.DocNotFoundError:
+            self.db.reopen()
+        try:
+            return self.db[docid]
+        except xapian.DocNotFoundError:
+            return None
+
+    def _build(self, pos):
+        docid, percent = self.matches[pos]
+        total = self.total
+        if total is None:
+            total = '?'
+        doc = self._get_doc(docid)
+        if doc is None:
+            item = MissingItem(docid, pos+1, total)
+        else:
+            doc.matchp = percent
+            item = DocItem(doc, pos+1, total)
+        self.items[pos] = item
+        while len(self.items) > self.CACHE_SIZE:
+            self.items.popitem(last=False)
+        return item
 
     def __getitem__(self, pos):
-        if pos < 0:
+        if pos < 0 or pos >= self.ndocs:
             raise IndexError
-        if pos not in self.items:
-            self.items[pos] = DocItem(self.docs[pos], pos+1, self.ndocs)
-        return self.items[pos]
+        item = self.items.pop(pos, None)
+        if item is None:
+            item = self._build(pos)
+            # rows are first built when the screen is drawn, which is
+            # also when the neighbouring rows should be prefetched
+            self.prefetch()
+            return item
+        self.items[pos] = item
+        return item
 
     def set_focus(self, focus):
         if focus == -1:
             focus = self.ndocs - 1
         self.focus = focus
         self._modified()
+        self.prefetch()
+
+    def prefetch(self):
+        """Schedule building the rows around the focus."""
+        if self.schedule and not self._prefetch_pending:
+            self._prefetch_pending = True
+            self.schedule(self._prefetch)
+
+    # build a few of the missing rows around the focus, nearest first,
+    # and reschedule while there are more
+    def _prefetch(self):
+        self._prefetch_pending = False
+        built = 0
+        for dist in range(1, self.PREFETCH + 1):
+            for pos in [self.focus + dist, self.focus - dist]:
+                if pos < 0 or pos >= self.ndocs or pos in self.items:
+                    continue
+                if built == self.PREFETCH_STEP:
+                    self.prefetch()
+                    return
+                self._build(pos)
+                built += 1
 
     def next_position(self, pos):
         return pos + 1
@@ -152,7 +267,91 @@ class DocWalker(urwid.ListWalker):
         
 ############################################################
 
+class Searcher(threading.Thread):
+    """Run a search in a background thread.
+
+    Results are put on 'queue' as they are retrieved, as messages:
+    ('matches', [(docid, percent), ...]) for each page of results,
+    ('total', count) once the exact number of matches is known (only
+    if 'count' is True), and finally one of ('done',), ('cancelled',)
+    or ('error', message).  If 'pipe' is given a byte is written to
+    it after each message, to wake the main loop, and it is closed
+    after the last.
+
+    The search opens its own database, as database objects can not be
+    shared between threads.
+
+    """
+
+    FIRST_PAGE = 50
+
+    def __init__(self, root, query, sort=None, offset=0, count=True, pipe=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.root = root
+        self.query = query
+        self.sort = sort
+        self.offset = offset
+        self.count = count
+        self.pipe = pipe
+        self.queue = Queue.Queue()
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop the search, at the next page of results."""
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def _post(self, *msg):
+        self.queue.put(msg)
+        if self.pipe is not None:
+            os.write(self.pipe, '.')
+
+    def run(self):
+        try:
+            self._search()
+        finally:
+            if self.pipe is not None:
+                os.close(self.pipe)
+
+    def _search(self):
+        try:
+            with Database(self.root) as db:
+                count = self.count
+                for matches in db.iter_matches(self.query, sort=self.sort,
+                                               offset=self.offset,
+                                               pagesize=self.FIRST_PAGE):
+                    if self.is_cancelled():
+                        self._post('cancelled')
+                        return
+                    self._post('matches', matches)
+                    # count once the first page is shown
+                    if count:
+                        self._post('total', db.count(self.query))
+                        count = False
+                if count:
+                    self._post('total', db.count(self.query))
+            self._post('done')
+        except Exception as e:
+            self._post('error', str(e))
+
+############################################################
+
 class Search(urwid.WidgetWrap):
+    """Search results buffer.
+
+    The search runs in a Searcher thread, started with the main loop
+    (see start()), and results are shown as they arrive.  Only one
+    search runs at a time: starting a new one cancels the search in
+    flight, which picks up where it left off when its buffer is
+    returned to (see resume()).
+
+    """
+
+    # the search currently running
+    _active = None
 
     palette = [
         ('head', 'dark blue, bold', ''),
@@ -177,6 +376,7 @@ class Search(urwid.WidgetWrap):
         ('<', "firstEntry"),
         ('>', "lastEntry"),
         ('=', "refresh"),
+        ('o', "cycleSort"),
         ('l', "filterSearch"),
         ('enter', "viewFile"),
         ('u', "viewURL"),
@@ -190,33 +390,122 @@ class Search(urwid.WidgetWrap):
         ('meta b', "copyBibtex"),
         ])
 
-    def __init__(self, ui, query=None):
+    def __init__(self, ui, query=None, sort=None):
         self.ui = ui
         self.query = query
+        self.sort = sort
+        self.mainloop = None
+        self.searcher = None
+        self.complete = False
 
-        count = self.ui.db.count(query)
-        if count == 0:
-            self.ui.set_status('No documents found.')
-            docs = []
-        else:
-            docs = [doc for doc in self.ui.db.search(query)]
-        if count == 1:
-            cstring = "%d result" % (count)
+        self.docwalker = DocWalker(self.ui.db, schedule=self._schedule)
+        self.listbox = urwid.ListBox(self.docwalker)
+        w = self.listbox
+        self._set_header()
+
+        self.__super.__init__(w)
+
+    def start(self, mainloop):
+        """Start the search in the background of the main loop."""
+        self.mainloop = mainloop
+        self._search()
+
+    def resume(self):
+        """Continue the search if it was cancelled by a later one."""
+        # deferred to the main loop, so that nothing is started if
+        # the buffer is killed straight away
+        # a search left running by a killed buffer is of no more use
+        if Search._active and Search._active is not self.searcher:
+            Search._active.cancel()
+        if self.mainloop and not self.complete:
+            self.mainloop.set_alarm_in(0, lambda loop, data: self._resume())
+
+    def _resume(self):
+        if self.complete:
+            return
+        if self.searcher is None or self.searcher.is_cancelled():
+            self._search()
+
+    def load(self):
+        """Run the search to completion, without a main loop."""
+        self.searcher = Searcher(self.ui.db.root, self.query, sort=self.sort)
+        self.searcher.run()
+        # the search has ended, as if the pipe had been closed
+        self._receive(self.searcher, '')
+
+    def _search(self):
+        # continue from the matches already shown, so a resumed search
+        # only retrieves the rest
+        walker = self.docwalker
+        searcher = Searcher(self.ui.db.root, self.query, sort=self.sort,
+                            offset=walker.ndocs, count=walker.total is None)
+        searcher.pipe = self.mainloop.watch_pipe(
+            lambda data: self._receive(searcher, data))
+        if Search._active:
+            Search._active.cancel()
+        Search._active = self.searcher = searcher
+        searcher.start()
+
+    # handle messages from a searcher, in the main loop.  messages
+    # from a searcher that has been replaced are dropped, as the
+    # replacement retrieves the same matches again.  empty data means
+    # the searcher has closed its end of the pipe, after its last
+    # message.
+    def _receive(self, searcher, data):
+        finished = data == ''
+        while True:
+            try:
+                msg = searcher.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if msg[0] in ['done', 'cancelled', 'error']:
+                finished = True
+            if searcher is not self.searcher:
+                continue
+            if msg[0] == 'matches':
+                self.docwalker.extend(msg[1])
+            elif msg[0] == 'total':
+                self.docwalker.set_total(msg[1])
+                if msg[1] == 0:
+                    self.ui.set_status('No documents found.')
+            elif msg[0] == 'done':
+                self.complete = True
+            elif msg[0] == 'error':
+                self.ui.set_status('Search failed: %s' % msg[1])
+        if finished:
+            if searcher is self.searcher:
+                self.searcher = None
+            if searcher is Search._active:
+                Search._active = None
+        if searcher is self.searcher or finished:
+            self._set_header()
+        # returning False removes the watch and closes the pipe, which
+        # must wait for the searcher to close its end: wakeup bytes
+        # may still be being written after the last message is queued
+        return data != ''
+
+    def _set_header(self):
+        walker = self.docwalker
+        if walker.total is None:
+            cstring = "searching..."
+            if walker.ndocs:
+                cstring = "%d+ results" % (walker.ndocs)
+        elif walker.total == 1:
+            cstring = "%d result" % (walker.total)
         else:
-            cstring = "%d results" % (count)
+            cstring = "%d results" % (walker.total)
+        if walker.total is not None and walker.ndocs < walker.total \
+                and not self.complete:
+            cstring += " (%d loaded)" % (walker.ndocs)
+
+        if self.sort:
+            cstring += ", by %s" % (self.sort)
 
         self.ui.set_header([urwid.Columns([
             urwid.Text("search: \"%s\"" % (self.query)),
             urwid.Text(cstring, align='right'),
             ])])
 
-        self.lenitems = count
-        self.docwalker = DocWalker(docs)
-        self.listbox = urwid.ListBox(self.docwalker)
-        w = self.listbox
-
-        self.__super.__init__(w)
-
     def keypress(self, size, key):
         if key in self.keys:
             cmd = "self.%s()" % (self.keys[key])
@@ -224,12 +513,36 @@ class Search(urwid.WidgetWrap):
         else:
             self.ui.keypress(key)
 
+    # run callback from the main loop after pending input and screen
+    # updates are handled.  the buffer is created before the main
+    # loop, which also does not exist when rendered headless.
+    def _schedule(self, callback):
+        if self.mainloop:
+            self.mainloop.set_alarm_in(0.01, lambda loop, data: callback())
+
     ##########
 
+    # search command for this buffer's sort order and query terms
+    def _search_cmd(self, *terms):
+        cmd = ['search']
+        if self.sort:
+            cmd.append('--sort=%s' % self.sort)
+        return cmd + list(terms)
+
     def refresh(self):
         """refresh current search results"""
         entry, pos = self.listbox.get_focus()
-        self.ui.newbuffer(['search', self.query])
+        self.ui.newbuffer(self._search_cmd(self.query))
+        self.ui.killBuffer()
+
+    def cycleSort(self):
+        """cycle through search result sort orders"""
+        orders = self.ui.db.SORT_ORDERS
+        if self.sort in orders:
+            self.sort = orders[(orders.index(self.sort) + 1) % len(orders)]
+        else:
+            self.sort = orders[1]
+        self.ui.newbuffer(self._search_cmd(self.query))
         self.ui.killBuffer()
 
     def filterSearch(self):
@@ -243,13 +556,13 @@ class Search(urwid.WidgetWrap):
         if not newquery:
             self.ui.set_status()
             return
-        self.ui.newbuffer(['search', self.query, newquery])
+        self.ui.newbuffer(self._search_cmd(self.query, newquery))
 
     def nextEntry(self):
         """next entry"""
         entry, pos = self.listbox.get_focus()
         if not entry: return
-        if pos + 1 >= self.lenitems: return
+        if pos + 1 >= self.docwalker.ndocs: return
         self.listbox.set_focus(pos + 1)
 
     def prevEntry(self):
@@ -259,6 +572,15 @@ class Search(urwid.WidgetWrap):
         if pos == 0: return
         self.listbox.set_focus(pos - 1)
 
+    # return the focused entry, or None if there is none or its
+    # document has been deleted
+    def _entry(self):
+        entry = self.listbox.get_focus()[0]
+        if entry and entry.doc is None:
+            self.ui.set_status('Document id:%d has been deleted.' % entry.docid)
+            return None
+        return entry
+
     def lastEntry(self):
         """last entry"""
         self.listbox.set_focus(-1)
@@ -269,7 +591,7 @@ class Search(urwid.WidgetWrap):
 
     def viewFile(self):
         """open document file"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         path = entry.doc.get_fullpaths()
         if not path:
@@ -287,7 +609,7 @@ class Search(urwid.WidgetWrap):
 
     def viewURL(self):
         """open document URL in browser"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         urls = entry.doc.get_urls()
         if not urls:
@@ -303,13 +625,13 @@ class Search(urwid.WidgetWrap):
 
     def viewBibtex(self):
         """view document bibtex"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         self.ui.newbuffer(['bibview', 'id:' + str(entry.docid)])
 
     def copyID(self):
         """copy document ID to clipboard"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         docid = "id:%d" % entry.docid
         xclip(docid)
@@ -317,7 +639,7 @@ class Search(urwid.WidgetWrap):
 
     def copyPath(self):
         """copy document file path to clipboard"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         path = entry.doc.get_fullpaths()[0]
         if not path:
@@ -328,7 +650,7 @@ class Search(urwid.WidgetWrap):
 
     def copyURL(self):
         """copy document URL to clipboard"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         urls = entry.doc.get_urls()
         if not urls:
@@ -341,7 +663,7 @@ class Search(urwid.WidgetWrap):
 
     def copyBibtex(self):
         """copy document bibtex to clipboard"""
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         bibtex = entry.doc.get_bibpath()
         if not bibtex:
@@ -359,7 +681,7 @@ class Search(urwid.WidgetWrap):
         self.promptTag('-')
 
     def promptTag(self, sign):
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
         if not entry: return
         if sign is '+':
             # FIXME: autocomplete to existing tags
@@ -375,7 +697,8 @@ class Search(urwid.WidgetWrap):
         if not tag_string:
             self.ui.set_status('No tags set.')
             return
-        entry = self.listbox.get_focus()[0]
+        entry = self._entry()
+        if not entry: return
         try:
             with initdb(writable=True) as db:
                 doc = db[entry.docid]
@@ -60,8 +60,12 @@ class UI():
             cmd = ['search', '*']
 
         if cmd[0] == 'search':
+            sort = None
+            if len(cmd) > 1 and cmd[1].startswith('--sort='):
+                sort = cmd[1].split('=',1)[1]
+                cmd = cmd[:1] + cmd[2:]
             query = ' '.join(cmd[1:])
-            self.buffer = Search(self, query)
+            self.buffer = Search(self, query, sort=sort)
         elif cmd[0] == 'bibview':
             query = ' '.join(cmd[1:])
             self.buffer = Bibview(self, query)
@@ -87,6 +91,8 @@ class UI():
             handle_mouse=False,
             )
         self.mainloop.screen.set_terminal_properties(colors=88)
+        if hasattr(self.buffer, 'start'):
+            self.buffer.start(self.mainloop)
         self.mainloop.run()
 
     ##########
@@ -107,6 +113,8 @@ class UI():
     def newbuffer(self, cmd):
         UI(cmd=cmd)
         self.set_status()
+        if hasattr(self.buffer, 'resume'):
+            self.buffer.resume()
 
     def prompt(self, string):
         prompt = PromptEdit(string)
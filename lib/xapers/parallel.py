@@ -0,0 +1,33 @@
+import collections
+
+##################################################
+
+def imap(func, items, jobs=1):
+    """Apply func to items using a pool of 'jobs' threads.
+
+    Returns an iterator over (item, result) tuples, in the order of
+    the input items.  At most twice 'jobs' items are in flight at any
+    time, so results are never produced much faster than they are
+    consumed.  An exception raised by func is re-raised when its
+    result is reached.
+
+    """
+    if jobs <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append((item, pool.apply_async(func, (item,))))
+            if len(pending) >= 2 * jobs:
+                item, result = pending.popleft()
+                yield item, result.get()
+        while pending:
+            item, result = pending.popleft()
+            yield item, result.get()
+    finally:
+        pool.terminate()
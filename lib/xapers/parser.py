@@ -1,5 +1,7 @@
 import os
 
+import parallel
+
 ##################################################
 
 class ParseError(Exception):
@@ -21,10 +23,25 @@ class ParserBase():
 
 ##################################################
 
+# cache of extracted text, consulted by all parse functions if set
+_text_cache = None
+
+def set_text_cache(cache):
+    """Set TextCache to be used for extracted document text."""
+    global _text_cache
+    _text_cache = cache
+
 def parse_data(data):
     # FIXME: determine mime type
     mimetype = 'pdf'
 
+    cache = _text_cache
+    if cache:
+        key = cache.key_for_data(data)
+        text = cache.get(key)
+        if text is not None:
+            return text
+
     from xapers.parsers.pdf import extract
 
     try:
@@ -32,6 +49,9 @@ def parse_data(data):
     except Exception, e:
         raise ParseError("Could not parse file: %s" % e)
 
+    if cache:
+        cache.put(key, text)
+
     return text
 
 def parse_file(path):
@@ -51,9 +71,35 @@ def parse_file(path):
     if not os.path.isfile(path):
         raise ParseError("File '%s' is not a regular file." % path)
 
+    cache = _text_cache
+    if cache:
+        key = cache.key_for_file(path)
+        text = cache.get(key)
+        if text is not None:
+            return text
+
     try:
         text = pmod(path).extract()
     except Exception, e:
         raise ParseError("Could not parse file: %s" % e)
 
+    if cache:
+        cache.put(key, text)
+
     return text
+
+def _parse_file(path):
+    try:
+        return parse_file(path)
+    except ParseError as e:
+        return e
+
+def parse_files(paths, jobs=1):
+    """Parse files, running up to 'jobs' parsers in parallel.
+
+    Returns an iterator over (path, text) tuples, in the order of the
+    input paths.  If a file could not be parsed its text is the
+    ParseError, so that one bad file does not stop the rest.
+
+    """
+    return parallel.imap(_parse_file, paths, jobs)
@@ -1,4 +1,5 @@
 from ..parser import ParserBase
+from ..instrument import timer
 
 import subprocess
 
@@ -8,15 +9,19 @@ def extract(data):
                             stdin=subprocess.PIPE,
                             stdout=subprocess.PIPE,
                             stderr=open('/dev/null','w'),
+                            close_fds=True,
                             )
-    (stdout, stderr) = proc.communicate(input=data)
-    proc.wait()
+    with timer('pdftotext'):
+        (stdout, stderr) = proc.communicate(input=data)
+        proc.wait()
     return stdout
 
 class Parser(ParserBase):
     def extract(self):
         cmd = ['pdftotext', self.path, '-']
 
-        text = subprocess.check_output(cmd, stderr=open('/dev/null','w'))
+        with timer('pdftotext'):
+            text = subprocess.check_output(cmd, stderr=open('/dev/null','w'),
+                                           close_fds=True)
 
         return text
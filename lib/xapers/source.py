@@ -1,9 +1,14 @@
 import os
 import re
+import time
+import urllib2
 import pkgutil
+import threading
 from urlparse import urlparse
 
 import sources
+import parallel
+from fetch import FetchError
 from parser import parse_file
 
 ##################################################
@@ -27,9 +32,10 @@ class Source(object):
     possibly user-defined source module.
 
     """
-    def __init__(self, name, module):
+    def __init__(self, name, module=None, loader=None):
         self.name = name
-        self.module = module
+        self._module = module
+        self._loader = loader
 
     def __repr__(self):
         return '%s(%s, %s)' % (self.__class__, self.name, self.module)
@@ -40,6 +46,16 @@ class Source(object):
     def __getitem__(self, id):
         return SourceItem(self, id)
 
+    @property
+    def module(self):
+        # source modules are only loaded when first needed
+        if self._module is None:
+            with _load_lock:
+                if self._module is None:
+                    loader = self._loader.find_module(self.name)
+                    self._module = loader.load_module(self.name)
+        return self._module
+
     @property
     def path(self):
         return self.module.__file__
@@ -85,6 +101,13 @@ class Source(object):
             raise SourceAttributeError(self, "fetch_bibtex() function")
 
     def fetch_file(self, id):
+        """Fetch the document file for id.
+
+        Returns a (name, data) tuple.  data is either the file
+        contents, or an open file (usually a temporary file streamed
+        from the source) that the caller is responsible for closing.
+
+        """
         try:
             return self.module.fetch_file(id)
         except AttributeError:
@@ -95,10 +118,15 @@ class SourceItem(Source):
 
     """
     def __init__(self, source, id):
-        super(SourceItem, self).__init__(source.name, source.module)
+        super(SourceItem, self).__init__(source.name)
+        self.source = source
         self.id = id
         self.sid = '%s:%s' % (self.name, self.id)
 
+    @property
+    def module(self):
+        return self.source.module
+
     def __repr__(self):
         s = super(SourceItem, self).__repr__()
         return '%s(%s, %s)' % (self.__class__, s, self.id)
@@ -124,6 +152,14 @@ class SourceItem(Source):
         except AttributeError:
             raise SourceAttributeError(self, "'url_format' property")
 
+    @property
+    def host(self):
+        """Host serving the item, or the source name if unknown."""
+        try:
+            return urlparse(self.url).netloc or self.name
+        except SourceAttributeError:
+            return self.name
+
     def fetch_bibtex(self):
         return super(SourceItem, self).fetch_bibtex(self.id)
 
@@ -132,24 +168,50 @@ class SourceItem(Source):
 
 ##################################################
 
+# Process-wide registry of available sources, keyed on the source
+# search path.  Each entry records the modification times of the
+# source directories it was built from, and is rebuilt if any of them
+# change.
+_registry = {}
+_registry_lock = threading.Lock()
+_load_lock = threading.RLock()
+
+def _path_stamp(paths):
+    stamp = []
+    for path in paths:
+        try:
+            stamp.append((path, os.stat(path).st_mtime))
+        except OSError:
+            stamp.append((path, None))
+    return tuple(stamp)
+
 class Sources(object):
     def __init__(self):
-        self.sourcespath = sources.__path__
+        self.sourcespath = list(sources.__path__)
         extra = os.getenv('XAPERS_SOURCE_PATH', None)
         if extra:
             for path in extra.split(':'):
                 if path:
-                    sourcespath.insert(0, path)
+                    self.sourcespath.insert(0, path)
         else:
             self.sourcespath.insert(0, os.path.expanduser(os.path.join('~','.xapers','sources')))
 
-        self._sources = {}
-        for (loader, name, ispkg) in pkgutil.walk_packages(self.sourcespath):
-            if ispkg:
-                continue
-            #self._modules[name] = loader.find_module(name).load_module(name)
-            module = loader.find_module(name).load_module(name)
-            self._sources[name] = Source(name, module)
+        self._sources = self._lookup()
+
+    def _lookup(self):
+        key = tuple(self.sourcespath)
+        stamp = _path_stamp(self.sourcespath)
+        with _registry_lock:
+            entry = _registry.get(key)
+            if entry and entry[0] == stamp:
+                return entry[1]
+            found = {}
+            for (loader, name, ispkg) in pkgutil.iter_modules(self.sourcespath):
+                if ispkg:
+                    continue
+                found[name] = Source(name, loader=loader)
+            _registry[key] = (stamp, found)
+            return found
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__, self.sourcespath)
@@ -244,3 +306,73 @@ class Sources(object):
         if 'eprint' in fields:
             items.add(self.get_source('arxiv', fields['eprint']))
         return list(items)
+
+##################################################
+
+class HostLimiter(object):
+    """Limit the number of concurrent requests made to each host."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, host):
+        """Return a semaphore to hold while making a request to host."""
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self._semaphores[host]
+
+def _fetch_retry(func, retries, backoff):
+    # call func, retrying failures after exponentially increasing
+    # delays.  missing source module functions, responses not
+    # available offline and client errors are not retried.
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except (SourceAttributeError, FetchError):
+            raise
+        except urllib2.HTTPError as e:
+            if e.code < 500 or attempt >= retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+        except Exception:
+            if attempt >= retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+def fetch_items(items, files=False, jobs=1, per_host=2, retries=3, backoff=1.0):
+    """Fetch bibtex, and optionally files, for many source items.
+
+    Items are fetched by up to 'jobs' concurrent workers, with at most
+    'per_host' requests to any one host at a time.  Failed requests
+    are retried up to 'retries' times, after delays starting at
+    'backoff' seconds and doubling each time.
+
+    Returns an iterator over (item, result) tuples, in the order of
+    the input items.  result is a (bibtex, (name, data)) tuple, where
+    the file tuple is None if files were not requested, or the
+    exception raised if the item could not be fetched.  The file data
+    may be an open temporary file rather than a string, see
+    Source.fetch_file().
+
+    """
+    limiter = HostLimiter(per_host)
+
+    def fetch(item):
+        try:
+            with limiter(item.host):
+                bibtex = _fetch_retry(item.fetch_bibtex, retries, backoff)
+            filedata = None
+            if files:
+                with limiter(item.host):
+                    filedata = _fetch_retry(item.fetch_file, retries, backoff)
+            return bibtex, filedata
+        except Exception as e:
+            return e
+
+    return parallel.imap(fetch, items, jobs)
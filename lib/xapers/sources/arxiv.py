@@ -1,6 +1,6 @@
-import urllib
 from HTMLParser import HTMLParser
 from xapers.bibtex import data2bib
+from xapers.fetch import fetch, fetch_to_file
 
 description = "Open access e-print service"
 
@@ -60,9 +60,7 @@ class MyHTMLParser(HTMLParser):
 def fetch_bibtex(id):
     url = url_format % id
 
-    f = urllib.urlopen(url)
-    html = f.read()
-    f.close()
+    html = fetch(url)
 
     parser = MyHTMLParser()
     parser.feed(html)
@@ -80,8 +78,5 @@ def fetch_bibtex(id):
 
 def fetch_file(id):
     url = 'http://arxiv.org/pdf/%s' % id
-    f = urllib.urlopen(url)
-    data = f.read()
-    f.close()
     name = '%s.pdf' % id
-    return name, data
+    return name, fetch_to_file(url, suffix='.pdf')
@@ -1,5 +1,5 @@
-import urllib
 from HTMLParser import HTMLParser
+from xapers.fetch import fetch, fetch_to_file
 
 description = "Cryptology ePrint Archive"
 
@@ -41,9 +41,7 @@ class IACRParser(HTMLParser):
 def fetch_bibtex(id):
     url = bibtex_url % id
 
-    f = urllib.urlopen(url)
-    html = f.read()
-    f.close()
+    html = fetch(url)
 
     p = IACRParser()
     p.feed(html)
@@ -53,8 +51,6 @@ def fetch_bibtex(id):
 def fetch_file(id):
     url = pdf_url % id
 
-    f = urllib.urlopen(url)
-    pdf = f.read()
-    f.close()
+    pdf = fetch_to_file(url, suffix='.pdf')
 
     return (id.split('/').pop() + '.pdf', pdf)
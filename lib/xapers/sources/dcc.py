@@ -3,6 +3,7 @@ import pycurl
 import cStringIO
 import tempfile
 from xapers.bibtex import data2bib
+from xapers.fetch import cached
 
 description = "LIGO Document Control Center"
 
@@ -63,14 +64,21 @@ def dccXMLExtract(xmlstring):
     year = None
     return title, authors, year, abstract
 
-def fetch_bibtex(id):
-    xml = dccRetrieveXML(id)
-
+# retrieve document XML, failing rather than returning XML that can
+# not be parsed, so that only good responses are cached
+def dccRetrieveValidXML(docid):
+    xml = dccRetrieveXML(docid)
     try:
-        title, authors, year, abstract = dccXMLExtract(xml)
+        dccXMLExtract(xml)
     except:
         print >>sys.stderr, xml
         raise
+    return xml
+
+def fetch_bibtex(id):
+    xml = cached(url_format % id, lambda: dccRetrieveValidXML(id))
+
+    title, authors, year, abstract = dccXMLExtract(xml)
 
     data = {
         'institution': 'LIGO Laboratory',